@@ -11,14 +11,29 @@ CREATE TABLE app.raster
     folder_id VARCHAR(36)          NOT NULL,
     created TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP, -- e.g: 2024-01-25 15:12:11
     questionset_id VARCHAR(36),
+    hash   BIGINT,  -- CRC32 and size of the file, taken as it was uploaded
+    size   BIGINT,
+    -- kept up to date by the web workers as the raster goes through the pipeline
+    status       VARCHAR(16)      NOT NULL DEFAULT 'New'
+        CHECK (status IN ('New', 'Queued', 'Processing', 'Done', 'Invalid')),
+    chunks_total INTEGER,
+    chunks_done  INTEGER          NOT NULL DEFAULT 0,
+    -- where a zip member is in its ingest: 'upload' until it is uploaded and hashed, then
+    -- 'publish' until it is sent for indexing, NULL after that and for every other raster
+    ingest       VARCHAR(16)
+        CHECK (ingest IN ('upload', 'publish')),
     UNIQUE (file)
 );
 
+-- keyset pagination of the raster lists, by id within a status or folder
+CREATE INDEX raster_status ON app.raster (status, id);
+CREATE INDEX raster_folder ON app.raster (folder_id, id);
+
 CREATE TABLE app.raster_valid
 (
     raster    VARCHAR(36) PRIMARY KEY REFERENCES app.raster (id) ON DELETE CASCADE,
     hash      BIGINT      NOT NULL,
-    size      INTEGER     NOT NULL,
+    size      BIGINT      NOT NULL,
     width     INTEGER     NOT NULL,
     height    INTEGER     NOT NULL,
     bands     INTEGER     NOT NULL,
@@ -50,16 +65,30 @@ CREATE TABLE app.raster_tiled
 
 CREATE TABLE app.chunk
 (
-    id     VARCHAR(36) PRIMARY KEY NOT NULL,
+    id     VARCHAR(64) PRIMARY KEY NOT NULL,
     raster VARCHAR(36) REFERENCES app.raster_valid (raster) ON DELETE CASCADE,
     x      INTEGER                 NOT NULL,
     y      INTEGER                 NOT NULL,
+    message    TEXT,
+    dispatches INTEGER             NOT NULL DEFAULT 1,
+    done       BOOLEAN             NOT NULL DEFAULT FALSE,  -- counted in raster.chunks_done
     UNIQUE (raster, x, y)
 );
 
+CREATE TABLE app.chunk_progress
+(
+    chunk       VARCHAR(64) NOT NULL REFERENCES app.chunk (id) ON DELETE CASCADE,
+    dispatch    INTEGER     NOT NULL,
+    started     TIMESTAMP   NOT NULL DEFAULT NOW(),
+    updated     TIMESTAMP   NOT NULL DEFAULT NOW(),
+    tiles_done  INTEGER     NOT NULL,
+    tiles_total INTEGER     NOT NULL,
+    PRIMARY KEY (chunk, dispatch)
+);
+
 CREATE TABLE app.chunk_result
 (
-    chunk VARCHAR(36)  NOT NULL REFERENCES app.chunk (id) ON DELETE CASCADE,
+    chunk VARCHAR(64)  NOT NULL REFERENCES app.chunk (id) ON DELETE CASCADE,
     label VARCHAR(255) NOT NULL,
     file   VARCHAR(255) NOT NULL,
     PRIMARY KEY (chunk, label)
@@ -67,7 +96,7 @@ CREATE TABLE app.chunk_result
 
 CREATE TABLE app.chunk_failed
 (
-    chunk  VARCHAR(36) PRIMARY KEY NOT NULL REFERENCES app.chunk (id) ON DELETE CASCADE,
+    chunk  VARCHAR(64) PRIMARY KEY NOT NULL REFERENCES app.chunk (id) ON DELETE CASCADE,
     reason VARCHAR(255)            NOT NULL
 );
 
@@ -101,66 +130,217 @@ GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA app TO web;
 GRANT EXECUTE ON ALL FUNCTIONS IN SCHEMA app TO web;
 
 
+-- metrics per month of upload, kept up to date by the triggers below so that /metrics doesn't
+-- aggregate every raster on each request
+CREATE TABLE app.raster_metric_summary
+(
+    month           DATE             PRIMARY KEY,
+    count           BIGINT           NOT NULL DEFAULT 0,
+    valid_cnt       BIGINT           NOT NULL DEFAULT 0,
+    invalid_cnt     BIGINT           NOT NULL DEFAULT 0,
+    min_num_tiles   INTEGER,
+    max_num_tiles   INTEGER,
+    total_num_tiles BIGINT           NOT NULL DEFAULT 0,
+    min_area        DOUBLE PRECISION,
+    max_area        DOUBLE PRECISION,
+    total_area      DOUBLE PRECISION NOT NULL DEFAULT 0,
+    area_cnt        BIGINT           NOT NULL DEFAULT 0  -- rasters with an area, those without a CRS have none
+);
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON app.raster_metric_summary TO web;
+
+CREATE INDEX raster_created_month ON app.raster ((date_trunc('month', created)::date));
+
+-- recounts the given months from the raster tables, or every month
+CREATE OR REPLACE FUNCTION app.refresh_raster_metrics(months DATE[] DEFAULT NULL)
+RETURNS VOID AS $$
+BEGIN
+    IF months IS NULL THEN
+        -- waits for transactions already counting rasters, and holds off new ones until done
+        LOCK TABLE app.raster_metric_summary IN SHARE ROW EXCLUSIVE MODE;
+    ELSE
+        PERFORM 1 FROM app.raster_metric_summary WHERE month = ANY(months) FOR UPDATE;
+    END IF;
+
+    WITH recount AS (
+        SELECT
+            date_trunc('month', r.created)::date AS month,
+            COUNT(*) AS count,
+            COUNT(v.raster) AS valid_cnt,
+            COUNT(i.raster) AS invalid_cnt,
+            MIN(v.num_tiles_x * v.num_tiles_y) AS min_num_tiles,
+            MAX(v.num_tiles_x * v.num_tiles_y) AS max_num_tiles,
+            COALESCE(SUM(v.num_tiles_x * v.num_tiles_y), 0) AS total_num_tiles,
+            MIN(v.area) AS min_area,
+            MAX(v.area) AS max_area,
+            COALESCE(SUM(v.area), 0) AS total_area,
+            COUNT(v.area) AS area_cnt
+        FROM app.raster r
+        LEFT JOIN app.raster_valid v ON r.id = v.raster
+        LEFT JOIN app.raster_invalid i ON r.id = i.raster
+        WHERE months IS NULL OR date_trunc('month', r.created)::date = ANY(months)
+        GROUP BY 1
+    ), recounted AS (
+        INSERT INTO app.raster_metric_summary AS s
+        SELECT * FROM recount
+        ON CONFLICT (month) DO UPDATE SET
+            count = EXCLUDED.count,
+            valid_cnt = EXCLUDED.valid_cnt,
+            invalid_cnt = EXCLUDED.invalid_cnt,
+            min_num_tiles = EXCLUDED.min_num_tiles,
+            max_num_tiles = EXCLUDED.max_num_tiles,
+            total_num_tiles = EXCLUDED.total_num_tiles,
+            min_area = EXCLUDED.min_area,
+            max_area = EXCLUDED.max_area,
+            total_area = EXCLUDED.total_area,
+            area_cnt = EXCLUDED.area_cnt
+        RETURNING month
+    )
+    DELETE FROM app.raster_metric_summary s
+    WHERE (months IS NULL OR s.month = ANY(months))
+        AND s.month NOT IN (SELECT month FROM recounted);
+END;
+$$ LANGUAGE plpgsql;
+
+-- the triggers run once per statement, so a bulk load updates each month once
+CREATE OR REPLACE FUNCTION app.count_new_rasters()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO app.raster_metric_summary AS s (month, count)
+    SELECT date_trunc('month', created)::date, COUNT(*)
+    FROM new_rows
+    GROUP BY 1
+    ORDER BY 1
+    ON CONFLICT (month) DO UPDATE SET count = s.count + EXCLUDED.count;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER raster_metric_count
+    AFTER INSERT ON app.raster
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION app.count_new_rasters();
+
+CREATE OR REPLACE FUNCTION app.count_valid_rasters()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO app.raster_metric_summary AS s
+        (month, valid_cnt, min_num_tiles, max_num_tiles, total_num_tiles, min_area, max_area, total_area, area_cnt)
+    SELECT
+        date_trunc('month', r.created)::date,
+        COUNT(*),
+        MIN(v.num_tiles_x * v.num_tiles_y),
+        MAX(v.num_tiles_x * v.num_tiles_y),
+        SUM(v.num_tiles_x * v.num_tiles_y),
+        MIN(v.area),
+        MAX(v.area),
+        COALESCE(SUM(v.area), 0),
+        COUNT(v.area)
+    FROM new_rows v
+    INNER JOIN app.raster r ON r.id = v.raster
+    GROUP BY 1
+    ORDER BY 1
+    ON CONFLICT (month) DO UPDATE SET
+        valid_cnt = s.valid_cnt + EXCLUDED.valid_cnt,
+        min_num_tiles = LEAST(s.min_num_tiles, EXCLUDED.min_num_tiles),
+        max_num_tiles = GREATEST(s.max_num_tiles, EXCLUDED.max_num_tiles),
+        total_num_tiles = s.total_num_tiles + EXCLUDED.total_num_tiles,
+        min_area = LEAST(s.min_area, EXCLUDED.min_area),
+        max_area = GREATEST(s.max_area, EXCLUDED.max_area),
+        total_area = s.total_area + EXCLUDED.total_area,
+        area_cnt = s.area_cnt + EXCLUDED.area_cnt;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER raster_metric_valid
+    AFTER INSERT ON app.raster_valid
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION app.count_valid_rasters();
+
+CREATE OR REPLACE FUNCTION app.count_invalid_rasters()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO app.raster_metric_summary AS s (month, invalid_cnt)
+    SELECT date_trunc('month', r.created)::date, COUNT(*)
+    FROM new_rows i
+    INNER JOIN app.raster r ON r.id = i.raster
+    GROUP BY 1
+    ORDER BY 1
+    ON CONFLICT (month) DO UPDATE SET invalid_cnt = s.invalid_cnt + EXCLUDED.invalid_cnt;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER raster_metric_invalid
+    AFTER INSERT ON app.raster_invalid
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION app.count_invalid_rasters();
+
+-- minimums and maximums can't be taken back, so the months of deleted rasters are recounted
+CREATE OR REPLACE FUNCTION app.uncount_rasters()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM app.refresh_raster_metrics(ARRAY(SELECT DISTINCT date_trunc('month', created)::date FROM old_rows));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER raster_metric_uncount
+    AFTER DELETE ON app.raster
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION app.uncount_rasters();
+
 -- VIEW for API to get metrics
 CREATE VIEW app.raster_metric_monthly AS 
     SELECT     
-        --SUBSTRING(r.id, 1, 4) AS year, -- for test with dummy data
-        --SUBSTRING(r.id, 5, 2) AS month, -- for test with dummy data
-        EXTRACT(YEAR FROM r.created) AS year, 
-        EXTRACT(MONTH FROM r.created) AS month, 
-        COUNT(r.*) AS count,
-        MIN(v.num_tiles_x * v.num_tiles_y) AS min_num_tiles, 
-        MAX(v.num_tiles_x * v.num_tiles_y) AS max_num_tiles, 
-        AVG(v.num_tiles_x * v.num_tiles_y) AS avg_num_tiles, 
-        SUM(v.num_tiles_x * v.num_tiles_y) AS total_num_tiles, 
-        MIN(v.area) AS min_area, 
-        MAX(v.area) AS max_area,
-        AVG(v.area) AS mean_area,
-        SUM(v.area) AS total_area,
-        COUNT(i.*) AS invalid_cnt
-    FROM app.raster r 
-    LEFT JOIN app.raster_valid v ON r.id = v.raster 
-    LEFT JOIN app.raster_invalid i ON r.id = i.raster  
-    GROUP BY year, month;
+        EXTRACT(YEAR FROM s.month) AS year, 
+        EXTRACT(MONTH FROM s.month) AS month, 
+        s.count AS count,
+        s.min_num_tiles AS min_num_tiles, 
+        s.max_num_tiles AS max_num_tiles, 
+        s.total_num_tiles::numeric / NULLIF(s.valid_cnt, 0) AS avg_num_tiles, 
+        CASE WHEN s.valid_cnt > 0 THEN s.total_num_tiles END AS total_num_tiles, 
+        s.min_area AS min_area, 
+        s.max_area AS max_area,
+        s.total_area / NULLIF(s.area_cnt, 0) AS mean_area,
+        CASE WHEN s.area_cnt > 0 THEN s.total_area END AS total_area,
+        s.invalid_cnt AS invalid_cnt
+    FROM app.raster_metric_summary s;
 
 GRANT SELECT ON app.raster_metric_monthly TO web;
 
 CREATE VIEW app.raster_metric_yearly AS
     SELECT
-        --SUBSTRING(r.id, 1, 4) AS year,   -- for test with dummy data   
-        EXTRACT(YEAR FROM r.created) AS year, 
-        COUNT(r.*) AS count,
-        MIN(v.num_tiles_x * v.num_tiles_y) AS min_num_tiles, 
-        MAX(v.num_tiles_x * v.num_tiles_y) AS max_num_tiles, 
-        AVG(v.num_tiles_x * v.num_tiles_y) AS avg_num_tiles, 
-        SUM(v.num_tiles_x * v.num_tiles_y) AS total_num_tiles, 
-        MIN(v.area) AS min_area, 
-        MAX(v.area) AS max_area,
-        AVG(v.area) AS mean_area,
-        SUM(v.area) AS total_area,
-        COUNT(i.*) AS invalid_cnt
-    FROM app.raster r 
-    LEFT JOIN app.raster_valid v ON r.id = v.raster 
-    LEFT JOIN app.raster_invalid i ON r.id = i.raster  
+        EXTRACT(YEAR FROM s.month) AS year, 
+        SUM(s.count) AS count,
+        MIN(s.min_num_tiles) AS min_num_tiles, 
+        MAX(s.max_num_tiles) AS max_num_tiles, 
+        SUM(s.total_num_tiles)::numeric / NULLIF(SUM(s.valid_cnt), 0) AS avg_num_tiles, 
+        CASE WHEN SUM(s.valid_cnt) > 0 THEN SUM(s.total_num_tiles) END AS total_num_tiles, 
+        MIN(s.min_area) AS min_area, 
+        MAX(s.max_area) AS max_area,
+        SUM(s.total_area) / NULLIF(SUM(s.area_cnt), 0) AS mean_area,
+        CASE WHEN SUM(s.area_cnt) > 0 THEN SUM(s.total_area) END AS total_area,
+        SUM(s.invalid_cnt) AS invalid_cnt
+    FROM app.raster_metric_summary s
     GROUP BY year;
 
 GRANT SELECT ON app.raster_metric_yearly TO web;
 
 CREATE VIEW app.raster_metric AS
     SELECT 
-        COUNT(r.*) AS count,
-        MIN(v.num_tiles_x * v.num_tiles_y) AS min_num_tiles, 
-        MAX(v.num_tiles_x * v.num_tiles_y) AS max_num_tiles, 
-        AVG(v.num_tiles_x * v.num_tiles_y) AS avg_num_tiles, 
-        SUM(v.num_tiles_x * v.num_tiles_y) AS total_num_tiles, 
-        MIN(v.area) AS min_area, 
-        MAX(v.area) AS max_area,
-        AVG(v.area) AS mean_area,
-        SUM(v.area) AS total_area,
-        COUNT(i.*) AS invalid_cnt
-    FROM app.raster r 
-    LEFT JOIN app.raster_valid v ON r.id = v.raster 
-    LEFT JOIN app.raster_invalid i ON r.id = i.raster;
+        COALESCE(SUM(s.count), 0) AS count,
+        MIN(s.min_num_tiles) AS min_num_tiles, 
+        MAX(s.max_num_tiles) AS max_num_tiles, 
+        SUM(s.total_num_tiles)::numeric / NULLIF(SUM(s.valid_cnt), 0) AS avg_num_tiles, 
+        CASE WHEN SUM(s.valid_cnt) > 0 THEN SUM(s.total_num_tiles) END AS total_num_tiles, 
+        MIN(s.min_area) AS min_area, 
+        MAX(s.max_area) AS max_area,
+        SUM(s.total_area) / NULLIF(SUM(s.area_cnt), 0) AS mean_area,
+        CASE WHEN SUM(s.area_cnt) > 0 THEN SUM(s.total_area) END AS total_area,
+        COALESCE(SUM(s.invalid_cnt), 0) AS invalid_cnt
+    FROM app.raster_metric_summary s;
 
 GRANT SELECT ON app.raster_metric TO web;
 
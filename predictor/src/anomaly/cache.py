@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import rasterio
+from fs import open_fs
+
+from .logger import CustomLogger
+
+log = CustomLogger.setup_logger(__name__)
+
+# GDAL settings for reading remote rasters in place, fetching only the blocks that are needed
+vfs_options = dict(
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".tif",
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES",
+    GDAL_HTTP_MULTIRANGE="YES",
+    VSI_CACHE="TRUE",
+)
+
+
+class FileCache:
+    """
+    Local copies of remote files, kept within `max_bytes` by evicting the least recently used.
+
+    Files are named by a hash of their remote path, size and modification time, so a file that
+    changes remotely is fetched again. Downloads go to a temporary file that is renamed into
+    place once complete, and concurrent requests for the same file share one download. Files
+    handed out by `fetch` aren't evicted until they are released. Pins are only seen by the
+    process that holds them, so a cache directory shared between processes should be sized
+    for what they read at once. A pin older than `pin_seconds` is taken to have been leaked
+    and no longer counts.
+
+    This module is kept the same in the web and predictor packages.
+    """
+
+    def __init__(self, root, remote_fs_url, max_bytes, container="app-data", range_reads=True,
+                 pin_seconds=7 * 24 * 3600):
+        self.root = root
+        self.remote_fs_url = remote_fs_url
+        self.max_bytes = max_bytes
+        self.container = container
+        self.range_reads = range_reads
+        self.pin_seconds = pin_seconds
+        self.downloads = {}
+        self.pins = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def vfs_path(self, remote_fs, path):
+        """
+        Returns the path GDAL reads `path` of `remote_fs` at through its virtual filesystem.
+        """
+        fs_class_name = type(remote_fs).__name__
+        if fs_class_name == 'GCSFS':
+            return f"{self.remote_fs_url}/{path}"
+        elif fs_class_name == 'AzureBlobFS':
+            return f"{self.remote_fs_url}/{path}"
+        elif fs_class_name == 'BlobFSV2':
+            return f"/vsiaz/{self.container}/{path}"
+        elif fs_class_name == 'OSFS':
+            return f"{remote_fs.root_path}/{path}"
+        else:
+            raise ValueError(f"Unsupported filesystem type: {fs_class_name}")
+
+    async def locate(self, remote_file):
+        """
+        Returns a path rasterio can open `remote_file` at. Where the remote storage allows it this
+        is the remote file itself, so only the blocks that are needed are read, otherwise the
+        whole file is fetched into the cache and should be released once done with.
+        """
+        if self.range_reads:
+            def open_remote():
+                with open_fs(self.remote_fs_url) as fs:
+                    path = self.vfs_path(fs, remote_file)
+                with rasterio.Env(**vfs_options), rasterio.open(path, "r"):
+                    return path
+
+            try:
+                return await asyncio.to_thread(open_remote)
+            except Exception as e:
+                log.warning(f"Couldn't open {remote_file} remotely, downloading it instead: {e}")
+
+        return await self.fetch(remote_file)
+
+    def local_path(self, remote_file):
+        with open_fs(self.remote_fs_url) as fs:
+            info = fs.getinfo(remote_file, namespaces=["details"])
+        modified = info.modified.timestamp() if info.modified is not None else None
+        key = hashlib.blake2b(f"{self.remote_fs_url}/{remote_file}:{info.size}:{modified}".encode(),
+                              digest_size=16).hexdigest()
+        return os.path.join(self.root, key + os.path.splitext(remote_file)[1])
+
+    def download(self, remote_file, path):
+        fd, partial_file = tempfile.mkstemp(dir=self.root, suffix=".partial")
+        try:
+            with os.fdopen(fd, "wb") as f, open_fs(self.remote_fs_url) as fs, fs.open(remote_file, "rb") as remote:
+                shutil.copyfileobj(remote, f)
+            os.replace(partial_file, path)
+        except BaseException:
+            os.remove(partial_file)
+            raise
+
+    async def fetch(self, remote_file):
+        """
+        Returns the local path of `remote_file`, downloading it if it isn't cached. The file is
+        kept until `release` is called with the path.
+        """
+        path = await asyncio.to_thread(self.local_path, remote_file)
+
+        # pinned before checking for it, so that an eviction either sees the pin or happens first
+        with self.lock:
+            self.pins.setdefault(path, []).append(time.monotonic())
+
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+
+        download = self.downloads.get(path)
+        if download is None:
+            download = asyncio.ensure_future(asyncio.to_thread(self.download, remote_file, path))
+            self.downloads[path] = download
+            download.add_done_callback(lambda _: self.downloads.pop(path, None))
+        try:
+            await asyncio.shield(download)
+        except BaseException:
+            self.release(path)
+            raise
+
+        await asyncio.to_thread(self.evict)
+        return path
+
+    def release(self, path):
+        with self.lock:
+            pins = self.pins.get(path)
+            if pins:
+                pins.pop(0)
+                if not pins:
+                    del self.pins[path]
+
+    def evict(self):
+        with self.lock:
+            now = time.monotonic()
+            pinned = {path for path, pins in self.pins.items() if any(now - t < self.pin_seconds for t in pins)}
+
+            files = []
+            for entry in os.scandir(self.root):
+                if entry.is_file() and not entry.name.endswith(".partial"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                if path not in pinned:
+                    os.remove(path)
+                    total -= size
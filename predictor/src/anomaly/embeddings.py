@@ -0,0 +1,243 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+def create_exclusive(path, dtype, shape):
+    """
+    Creates a zero-filled .npy file at `path` unless there is one already. The file is written
+    under a temporary name and linked into place, so a file someone else has started writing
+    to is never replaced.
+    """
+    if os.path.exists(path):
+        return
+    fd, partial_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".partial")
+    os.close(fd)
+    try:
+        open_memmap(partial_file, mode="w+", dtype=dtype, shape=shape).flush()
+        os.link(partial_file, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(partial_file)
+
+
+class EmbeddingStore:
+    """
+    Memory-mapped store of the visual embeddings of the tiles of a raster, seen through the
+    window of tiles of one chunk.
+
+    Embeddings are keyed by the raster's CRC32 and size, the model, the tile size and overlap,
+    and the prefilter thresholds, which is everything that decides a tile's embedding. Within
+    that, tiles are indexed by their position in the whole raster, so a raster that is
+    submitted again (with any questionset, and however it is cut into chunks) finds the
+    embeddings of its earlier run. Tiles are kept in blocks of BLOCK_TILES x BLOCK_TILES:
+
+    - `{bx}-{by}.npy`: float16 array of shape (BLOCK_TILES, BLOCK_TILES, query_tokens, hidden_size)
+    - `{bx}-{by}.state.npy`: uint8 array of shape (BLOCK_TILES, BLOCK_TILES) holding the tile
+      states below. A chunk's states are only written once its embeddings are on disk.
+    - `meta.json`: what is needed to write results without opening the raster.
+    """
+
+    EMPTY = 0
+    EMBEDDED = 1
+    SKIPPED = 2
+    FILTERED = 3  # caught by the prefilter thresholds, which are part of the key
+
+    BLOCK_TILES = 16
+
+    def __init__(self, root, raster_hash, raster_size, model_name, grid, window, prefilter_key=""):
+        tile_key = f"{grid.tile_width}x{grid.tile_height}-{grid.tile_overlap_x}x{grid.tile_overlap_y}"
+        if prefilter_key:
+            tile_key += f"-{prefilter_key}"
+        self.key = os.path.join(f"{raster_hash:08x}-{raster_size}", model_name, tile_key)
+        self.path = os.path.join(root, self.key)
+
+        # (first_tile_x, first_tile_y, num_tiles_x, num_tiles_y) of the chunk in the whole raster
+        self.x_offset, self.y_offset, num_tiles_x, num_tiles_y = window
+        self.shape = (num_tiles_y, num_tiles_x)
+        self.states = None  # of the chunk's tiles, relative to the chunk
+        self.blocks = {}
+
+    def block_files(self, block_x, block_y):
+        return (
+            os.path.join(self.path, f"{block_x}-{block_y}.npy"),
+            os.path.join(self.path, f"{block_x}-{block_y}.state.npy"),
+        )
+
+    def meta_file(self):
+        return os.path.join(self.path, "meta.json")
+
+    def block_range(self):
+        """
+        Returns the (block_x, block_y) of every block the chunk's window touches.
+        """
+        num_tiles_y, num_tiles_x = self.shape
+        first_x, first_y = self.x_offset // self.BLOCK_TILES, self.y_offset // self.BLOCK_TILES
+        last_x = (self.x_offset + num_tiles_x - 1) // self.BLOCK_TILES
+        last_y = (self.y_offset + num_tiles_y - 1) // self.BLOCK_TILES
+        return [(bx, by) for by in range(first_y, last_y + 1) for bx in range(first_x, last_x + 1)]
+
+    def block_window(self, block_x, block_y):
+        """
+        Returns the slices of the block and of the chunk where the two overlap.
+        """
+        num_tiles_y, num_tiles_x = self.shape
+        x0 = max(block_x * self.BLOCK_TILES, self.x_offset)
+        y0 = max(block_y * self.BLOCK_TILES, self.y_offset)
+        x1 = min((block_x + 1) * self.BLOCK_TILES, self.x_offset + num_tiles_x)
+        y1 = min((block_y + 1) * self.BLOCK_TILES, self.y_offset + num_tiles_y)
+        in_block = (slice(y0 - block_y * self.BLOCK_TILES, y1 - block_y * self.BLOCK_TILES),
+                    slice(x0 - block_x * self.BLOCK_TILES, x1 - block_x * self.BLOCK_TILES))
+        in_chunk = (slice(y0 - self.y_offset, y1 - self.y_offset), slice(x0 - self.x_offset, x1 - self.x_offset))
+        return in_block, in_chunk
+
+    def read_states(self):
+        states = np.zeros(self.shape, dtype=np.uint8)
+        for block_x, block_y in self.block_range():
+            _, states_file = self.block_files(block_x, block_y)
+            if os.path.exists(states_file):
+                in_block, in_chunk = self.block_window(block_x, block_y)
+                states[in_chunk] = np.load(states_file, mmap_mode="r")[in_block]
+        return states
+
+    def is_complete(self):
+        return os.path.exists(self.meta_file()) and bool(np.all(self.read_states() != self.EMPTY))
+
+    def open(self):
+        """
+        Reads the states of the chunk's tiles for re-scoring, returning the raster's metadata.
+        """
+        self.states = self.read_states()
+        with open(self.meta_file(), "r") as f:
+            return json.load(f)
+
+    def read(self, tiles_y, tiles_x):
+        """
+        Returns the embeddings of the given tiles of the chunk.
+        """
+        tiles_y = np.asarray(tiles_y) + self.y_offset
+        tiles_x = np.asarray(tiles_x) + self.x_offset
+        blocks_y, blocks_x = tiles_y // self.BLOCK_TILES, tiles_x // self.BLOCK_TILES
+
+        embeddings = None
+        for block_x, block_y in set(zip(blocks_x.tolist(), blocks_y.tolist())):
+            in_block = (blocks_x == block_x) & (blocks_y == block_y)
+            block = np.load(self.block_files(block_x, block_y)[0], mmap_mode="r")
+            if embeddings is None:
+                embeddings = np.empty((len(tiles_x),) + block.shape[2:], dtype=block.dtype)
+            embeddings[in_block] = block[tiles_y[in_block] % self.BLOCK_TILES, tiles_x[in_block] % self.BLOCK_TILES]
+        return embeddings
+
+    def open_block(self, block_x, block_y, embedding_shape):
+        block = self.blocks.get((block_x, block_y))
+        if block is None:
+            embeddings_file, _ = self.block_files(block_x, block_y)
+            create_exclusive(embeddings_file, np.float16, (self.BLOCK_TILES, self.BLOCK_TILES) + tuple(embedding_shape))
+            block = self.blocks[(block_x, block_y)] = open_memmap(embeddings_file, mode="r+")
+        return block
+
+    def merge_states(self, block_x, block_y, states):
+        """
+        Records the states of a block's tiles, leaving the tiles that are EMPTY in `states` alone.
+        """
+        _, states_file = self.block_files(block_x, block_y)
+        create_exclusive(states_file, np.uint8, (self.BLOCK_TILES, self.BLOCK_TILES))
+        stored = open_memmap(states_file, mode="r+")
+        stored[states != self.EMPTY] = states[states != self.EMPTY]
+        stored.flush()
+
+    def write_meta(self, meta):
+        if os.path.exists(self.meta_file()):
+            return
+        with tempfile.NamedTemporaryFile("w", dir=self.path, suffix=".partial", delete=False) as f:
+            json.dump(meta, f)
+        os.replace(f.name, self.meta_file())
+
+    def create(self):
+        """
+        Starts recording the chunk's tiles. None of them count as stored until `finish`.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self.states = np.zeros(self.shape, dtype=np.uint8)
+
+    def write(self, tiles_y, tiles_x, embeddings):
+        self.states[tiles_y, tiles_x] = self.EMBEDDED
+        for tile_y, tile_x, embedding in zip(tiles_y, tiles_x, embeddings):
+            tile_y, tile_x = tile_y + self.y_offset, tile_x + self.x_offset
+            block = self.open_block(tile_x // self.BLOCK_TILES, tile_y // self.BLOCK_TILES, embedding.shape)
+            block[tile_y % self.BLOCK_TILES, tile_x % self.BLOCK_TILES] = embedding
+
+    def skip(self, tile_y, tile_x, state=SKIPPED):
+        self.states[tile_y, tile_x] = state
+
+    def finish(self, meta):
+        for block in self.blocks.values():
+            block.flush()
+        self.blocks = {}
+
+        for block_x, block_y in self.block_range():
+            in_block, in_chunk = self.block_window(block_x, block_y)
+            states = np.zeros((self.BLOCK_TILES, self.BLOCK_TILES), dtype=np.uint8)
+            states[in_block] = self.states[in_chunk]
+            self.merge_states(block_x, block_y, states)
+
+        self.write_meta(meta)
+
+    def discard(self):
+        # embeddings already written go unused until a chunk records their states
+        self.blocks = {}
+        self.states = None
+
+    def remote_file(self, local_file):
+        return os.path.join("embeddings", self.key, os.path.basename(local_file))
+
+    def upload(self, fs):
+        fs.makedirs(os.path.join("embeddings", self.key), recreate=True)
+        local_files = [f for block in self.block_range() for f in self.block_files(*block)] + [self.meta_file()]
+        for local_file in local_files:
+            if os.path.exists(local_file):
+                with open(local_file, "rb") as f, fs.open(self.remote_file(local_file), "wb") as remote:
+                    shutil.copyfileobj(f, remote)
+
+    def download(self, fs):
+        """
+        Fetches the blocks covering the chunk from remote storage, taking the tiles that aren't
+        stored locally yet. Returns False if the raster has none stored remotely.
+        """
+        if not fs.exists(self.remote_file(self.meta_file())):
+            return False
+
+        os.makedirs(self.path, exist_ok=True)
+        for block_x, block_y in self.block_range():
+            embeddings_file, states_file = self.block_files(block_x, block_y)
+            if not fs.exists(self.remote_file(states_file)):
+                continue
+
+            with tempfile.TemporaryDirectory(dir=self.path) as download_dir:
+                def fetch(local_file):
+                    download_file = os.path.join(download_dir, os.path.basename(local_file))
+                    with fs.open(self.remote_file(local_file), "rb") as remote, open(download_file, "wb") as f:
+                        shutil.copyfileobj(remote, f)
+                    return download_file
+
+                states = np.load(fetch(states_file))
+                if os.path.exists(states_file):
+                    states[np.load(states_file) != self.EMPTY] = self.EMPTY
+
+                embedded = states == self.EMBEDDED
+                if np.any(embedded):
+                    embeddings = np.load(fetch(embeddings_file), mmap_mode="r")
+                    block = self.open_block(block_x, block_y, embeddings.shape[2:])
+                    block[embedded] = embeddings[embedded]
+                    block.flush()
+                    self.blocks = {}
+                self.merge_states(block_x, block_y, states)
+
+        with fs.open(self.remote_file(self.meta_file()), "r") as f:
+            self.write_meta(json.load(f))
+        return True
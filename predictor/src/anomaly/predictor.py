@@ -1,9 +1,15 @@
 import asyncio
+import functools
+import hashlib
+import io
 import logging
 import os
 import random
 import shutil
-from dataclasses import dataclass, asdict
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, fields
+from typing import Optional
 import json
 
 import numpy as np
@@ -11,16 +17,22 @@ from affine import Affine
 from msgpack import packb, unpackb
 import yaml
 
+import torch
 from lavis.models import load_model_and_preprocess
+from transformers.modeling_outputs import BaseModelOutput
 
 from nats_worker import Worker
-from PIL import Image
 import rasterio
+from rasterio.enums import MaskFlags
 from rasterio.windows import Window
 
 from fs import open_fs
 from pathlib import Path
 import tempfile
+from .cache import FileCache, vfs_options
+from .embeddings import EmbeddingStore
+from .prefilter import Prefilter, tile_statistics
+from .tile_cache import TileCache, hash_tile
 from .logger import CustomLogger
 
 worker = Worker("predictor")
@@ -29,11 +41,20 @@ tmp_dir = tempfile.gettempdir()
 local_path_fs = f"{tmp_dir}/dra"
 remote_fs_url = os.getenv("REMOTE_FS", default=local_path_fs)
 Path(local_path_fs).mkdir(parents=True, exist_ok=True)
+container = os.getenv("REMOTE_CONTAINER", default="app-data")
+
+# read only the chunk's window of the source raster through GDAL's virtual filesystem,
+# instead of downloading all of it first
+range_reads = os.getenv("RANGE_READS", default="true").lower() == "true"
 
 cache_dir = os.path.expanduser(os.environ.get("CACHE_DIR", "~/.cache/dra"))
 log_dir = os.path.join(cache_dir, 'logs')
 log = CustomLogger.setup_logger(__name__, save_to_disk=True, log_dir=log_dir)
 
+# local copies of remote files are kept within this many bytes, least recently used first out
+cache_max_bytes = int(os.getenv("CACHE_MAX_BYTES", default=50 * 1024 ** 3))
+file_cache = FileCache(os.path.join(cache_dir, "files"), remote_fs_url, cache_max_bytes, container, range_reads)
+
 device = "cuda"
 
 # xxl is the only model that works, but you may want to use a smaller model while developing other parts of the system
@@ -41,6 +62,80 @@ pretrained_model_size = "xxl"
 model_size = os.getenv("MODEL_SIZE", default=pretrained_model_size)
 # model_size = "dummy"
 
+# number of tiles sent to the model together in a single generate call
+batch_size = int(os.getenv("BATCH_SIZE", default=16))
+
+# number of rows of tiles read from the raster in each call
+read_tile_rows = int(os.getenv("READ_TILE_ROWS", default=16))
+
+# chunks worked on at once: while one has the GPU, the others download, read and upload
+max_inflight_chunks = int(os.getenv("MAX_INFLIGHT_CHUNKS", default=2))
+chunk_ack_wait = 3600
+
+# a chunk's scores and how far it got are saved to remote storage this often, so that a
+# redelivered chunk carries on from there instead of starting over
+checkpoint_seconds = int(os.getenv("CHECKPOINT_SECONDS", default=300))
+
+# how many of a chunk's tiles are done is published this often, for the web worker to spot
+# chunks that have fallen behind
+progress_seconds = int(os.getenv("PROGRESS_SECONDS", default=60))
+
+# batches read ahead of the GPU, and the threads reading them
+prefetch_batches = int(os.getenv("PREFETCH_BATCHES", default=8))
+read_workers = int(os.getenv("READ_WORKERS", default=2))
+read_pool = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="read")
+
+# all model calls are made from this one thread, off the event loop
+gpu_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+
+# total seconds the GPU thread has spent without a batch while there were chunks to work on
+gpu_idle_seconds = 0.0
+gpu_last_busy = None
+active_pipelines = 0
+
+# default for questionsets that don't set one: "nucleus" samples a free-text answer, "greedy"
+# gives the same short answer every time, "score" picks the most likely of the node's answers
+decoding = os.getenv("DECODING", default="nucleus")
+
+generation_settings = {
+    "nucleus": dict(
+        do_sample=True,
+        top_p=0.9,
+        temperature=1,
+        num_beams=5,
+        max_new_tokens=30,
+        min_length=1,
+        repetition_penalty=1.5,
+        length_penalty=1,
+    ),
+    "greedy": dict(
+        do_sample=False,
+        num_beams=1,
+        max_new_tokens=10,
+        min_length=1,
+    ),
+}
+decoding_modes = [*generation_settings, "score"]
+
+# visual embeddings of every tile are kept here, keyed by raster hash and size, so that the same
+# raster can be re-scored with another questionset without running the vision encoder. They take
+# about 48 KB a tile, more than the source, and are never evicted, so they are off unless a
+# directory is given. With EMBEDDING_REMOTE=true they are also shared through REMOTE_FS.
+embedding_dir = os.path.expanduser(os.getenv("EMBEDDING_DIR", default=""))
+embedding_remote = os.getenv("EMBEDDING_REMOTE", default="false").lower() == "true"
+
+# scores of recently seen tiles, keyed by their pixels, the questionset and the decoding, so
+# repeated tiles skip the model. Only the "greedy" and "score" decodings are cached, as nucleus
+# sampling gives a different answer each time. Set TILE_CACHE_SIZE=0 to disable, and
+# TILE_CACHE_DIR to keep them on disk as well. TILE_CACHE_QUANTIZE_BITS low bits of each pixel
+# are ignored.
+tile_cache_size = int(os.getenv("TILE_CACHE_SIZE", default=100000))
+tile_cache_dir = os.path.expanduser(os.getenv("TILE_CACHE_DIR", default=""))
+tile_cache_quantize_bits = int(os.getenv("TILE_CACHE_QUANTIZE_BITS", default=0))
+tile_cache = TileCache(
+    tile_cache_size, os.path.join(tile_cache_dir, "tiles.sqlite") if tile_cache_dir else None
+) if tile_cache_size > 0 else None
+
 model, vis_processors, text_processors = load_model_and_preprocess(
     "blip2_t5", f"pretrain_flant5{model_size}", device=device, is_eval=True
 ) if model_size != "dummy" else (None, None, None)
@@ -54,87 +149,224 @@ class Chunk:
     effectset: list
     grid: dict
     chunk: list
+    hash: Optional[int] = None
+    size: Optional[int] = None
+    prefilter: Optional[dict] = None
+    decoding: Optional[str] = None
+    chunk_file: Optional[str] = None  # slice of the source holding just this chunk
+    chunk_offset: Optional[list] = None  # column and row of the slice in the source
+    dispatch: int = 0  # how many times the chunk was sent out before this
 
-def explore_questionset(img_features, subquestions, path, effectset, effects_dict):
+@dataclass
+class TileState:
+    tile: int  # index of the tile within the batch
+    questions: list  # the sibling questions at the tile's current level of the tree
+    position: int  # index of the question the tile is waiting on
+    effectset: list  # effects that have not been scored yet
+    effects_dict: dict
+    path: str = ""
+
+
+def advance_tile(state, decision_tree_cursor, answer):
+    """
+    Moves a tile on from the question it has just answered. Returns False once the tile has
+    finished with the tree.
+    """
+    question = decision_tree_cursor["text"]
+    answer_item = [each for each in decision_tree_cursor["answers"] if each['text'] == answer]
+
+    # if the model gives unexpected answer, skip that path.
+    if not answer_item:
+        log.info(f"model_answer: {answer} not in available answers. Skip this path.")
+        state.position += 1
+        return state.position < len(state.questions)
+
+    state.path += f"{question}/{answer}/" # for checking whether correctly tracking scores.
 
-    for decision_tree_cursor in subquestions:
-        question = decision_tree_cursor["text"]
-        prompt = f"Question: {question} Answer: "
+    try:
+        effects = answer_item[0]['effects']
+        subquestions = answer_item[0]['subquestions']
 
-        answers_list= [ each['text'] for each in decision_tree_cursor["answers"]]
+        for effect in effects:
+            name = effect['name']
+            score = effect['value']
+            effect_path = state.path + name
 
-        if model is not None:
-            answer = apply_model(img_features, prompt)
-        else: 
-            answer = random.choice(answers_list + ["none of the above"])
+            if state.effectset and name in state.effectset:
+                state.effectset.remove(name)
+                state.effects_dict[name] = {'score':score, 'path':effect_path}
 
+            if not state.effectset:
+                break
+    except KeyError:
+        return False
 
-        answer_item = [each for each in decision_tree_cursor["answers"] if each['text'] == answer]
+    if not state.effectset: # nothing left to score
+        return False
 
-        # if the model gives unexpected answer, skip that path.
-        if not answer_item:   
-            log.info(f"model_answer: {answer} not in available answers. Skip this path.")      
-            # return effects_dict
-            continue
+    if subquestions:
+        state.questions = subquestions
+        state.position = 0
+        return True
 
-        path += f"{question}/{answer}/" # for checking whether correctly tracking scores.
+    state.position += 1
+    return state.position < len(state.questions)
 
-        if answer_item:
-            effects = answer_item[0]['effects']
-            subquestions = answer_item[0]['subquestions']
 
-            try:
-                for effect in effects:
-                    name = effect['name']
-                    score = effect['value']
-                    effect_path = path + name
+def evaluate_questionset(questionset, effectset, effects_dict, num_tiles, answer_questions, path=""):
+    """
+    Walks the question tree for a batch of tiles one level at a time. On every step the
+    tiles are grouped by the question they are waiting on, each group is answered with a
+    single call to `answer_questions(decision_tree_cursor, tiles)`, and each tile is then
+    routed to its next question based on its own answer.
 
-                    if effectset and name in effectset:
-                        effectset.remove(name)                   
-                        effects_dict[name] = {'score':score, 'path':effect_path}
+    Returns the effects dict for each tile.
+    """
+    states = [
+        TileState(tile, questionset, 0, effectset.copy(), effects_dict.copy(), path)
+        for tile in range(num_tiles)
+    ]
+    active = [state for state in states if state.questions and state.effectset]
 
-                    if not effectset:
-                        break
-                
-                if effectset and subquestions:              
-                    effects_dict = explore_questionset(img_features, subquestions, path, effectset, effects_dict)
-                    return effects_dict
-                    # print('next decision_tree_cursor:', decision_tree_cursor)
-            except KeyError:
-                break        
+    while active:
+        groups = {}
+        for state in active:
+            decision_tree_cursor = state.questions[state.position]
+            groups.setdefault(id(decision_tree_cursor), (decision_tree_cursor, []))[1].append(state)
 
-        if not effectset: # break because effects_set is empty
-            break
+        active = []
+        for decision_tree_cursor, group in groups.values():
+            answers = answer_questions(decision_tree_cursor, [state.tile for state in group])
+            for state, answer in zip(group, answers):
+                if advance_tile(state, decision_tree_cursor, answer):
+                    active.append(state)
 
-    return effects_dict
+    return [state.effects_dict for state in states]
 
 
-async def download_and_cache(remote_file, dst_file):
-    def download(remote_file, dst_file):
-        if not os.path.exists(dst_file):
-            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
-            log.info(f"Downloading file {remote_file}")
-            with open_fs(remote_fs_url) as fs:
-                with fs.open(remote_file, "rb") as f:
-                    with open(dst_file, "wb") as f2:
-                        shutil.copyfileobj(f, f2)
-    await asyncio.to_thread(download, remote_file, dst_file)
+def answer_questions(query_embeds, decision_tree_cursor, tiles, mode=decoding):
+    question = decision_tree_cursor["text"]
+    prompt = f"Question: {question} Answer: "
 
+    answers_list = [each['text'] for each in decision_tree_cursor["answers"]]
 
-def apply_model(img_features, prefix=""):
     if model is None:
-        return "dummy"
-
-    model_output = model.generate(
-        {"image": img_features, "prompt": prefix},
-        use_nucleus_sampling=True,
-        temperature=1,
-        length_penalty=1,
-        repetition_penalty=1.5,
-        max_length=30,
+        return [random.choice(answers_list + ["none of the above"]) for _ in tiles]
+
+    if mode == "score" and answers_list:
+        return score_answers(query_embeds[tiles], [prompt] * len(tiles), answers_list)
+
+    return generate_answers(query_embeds[tiles], [prompt] * len(tiles), "nucleus" if mode == "score" else mode)
+
+
+@torch.no_grad()
+def encode_queries(img_features):
+    """
+    Runs the vision encoder and the Q-Former. This is the only part of the model that looks at
+    the pixels, so it is run once per tile and its projection is reused for every question. The
+    Q-Former output is much smaller than its projection, so this is what the embedding store keeps.
+    """
+    with model.maybe_autocast():
+        image_embeds = model.ln_vision(model.visual_encoder(img_features))
+    image_embeds = image_embeds.float()
+    image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+
+    query_tokens = model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+    query_output = model.Qformer.bert(
+        query_embeds=query_tokens,
+        encoder_hidden_states=image_embeds,
+        encoder_attention_mask=image_atts,
+        return_dict=True,
     )
-
-    return model_output[0]
+    return query_output.last_hidden_state
+
+
+@torch.no_grad()
+def project_queries(queries):
+    return model.t5_proj(queries.float())
+
+
+def embed_prompts(query_embeds, prompts):
+    """
+    Prepends the query embeddings of each tile to its tokenised prompt, as BLIP-2 does
+    before handing the sequence to the language model's encoder.
+    """
+    atts_t5 = torch.ones(query_embeds.size()[:-1], dtype=torch.long, device=query_embeds.device)
+    input_tokens = model.t5_tokenizer(prompts, padding="longest", return_tensors="pt").to(query_embeds.device)
+
+    inputs_embeds = model.t5_model.encoder.embed_tokens(input_tokens.input_ids)
+    inputs_embeds = torch.cat([query_embeds, inputs_embeds], dim=1)
+    encoder_atts = torch.cat([atts_t5, input_tokens.attention_mask], dim=1)
+    return inputs_embeds, encoder_atts
+
+
+@torch.no_grad()
+def generate_answers(query_embeds, prompts, mode="nucleus"):
+    """
+    Free-text answers for a batch of already encoded tiles, using the `mode` entry of
+    `generation_settings`. "nucleus" is what model.generate was previously called with.
+    """
+    with model.maybe_autocast(dtype=torch.bfloat16):
+        inputs_embeds, encoder_atts = embed_prompts(query_embeds, prompts)
+        outputs = model.t5_model.generate(
+            inputs_embeds=inputs_embeds,
+            attention_mask=encoder_atts,
+            num_return_sequences=1,
+            **generation_settings[mode],
+        )
+
+    return model.t5_tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+
+@torch.no_grad()
+def score_answers(query_embeds, prompts, candidates):
+    """
+    Scores every candidate answer for every tile by its mean log-likelihood per token under
+    the language model, using one encoder pass and one teacher-forced decoder pass for the whole
+    batch, and returns the most likely candidate for each tile. Averaging over the tokens keeps
+    longer answers from losing out just for their length.
+    """
+    output_tokens = model.t5_tokenizer(candidates, padding="longest", return_tensors="pt").to(query_embeds.device)
+    num_tiles, num_candidates = len(prompts), len(candidates)
+
+    with model.maybe_autocast(dtype=torch.bfloat16):
+        inputs_embeds, encoder_atts = embed_prompts(query_embeds, prompts)
+        encoder_output = model.t5_model.encoder(
+            inputs_embeds=inputs_embeds,
+            attention_mask=encoder_atts,
+            return_dict=True,
+        )
+
+        # each tile is decoded against each candidate, tile-major
+        labels = output_tokens.input_ids.masked_fill(
+            output_tokens.input_ids == model.t5_tokenizer.pad_token_id, -100
+        ).repeat(num_tiles, 1)
+        outputs = model.t5_model(
+            encoder_outputs=BaseModelOutput(
+                last_hidden_state=encoder_output.last_hidden_state.repeat_interleave(num_candidates, dim=0)
+            ),
+            attention_mask=encoder_atts.repeat_interleave(num_candidates, dim=0),
+            decoder_attention_mask=output_tokens.attention_mask.repeat(num_tiles, 1),
+            labels=labels,
+            return_dict=True,
+        )
+
+    log_probs = torch.log_softmax(outputs.logits.float(), dim=-1)
+    token_log_probs = log_probs.gather(-1, labels.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+    answer_mask = labels != -100
+    scores = ((token_log_probs * answer_mask).sum(dim=1) / answer_mask.sum(dim=1)).view(num_tiles, num_candidates)
+
+    return [candidates[i] for i in scores.argmax(dim=1).tolist()]
+
+
+def preprocess_tiles(tiles):
+    """
+    Applies the eval image processor to a whole NxHxWx3 batch of tiles at once on the GPU.
+    The tiles are already at the model's input size, so only scaling and normalisation apply.
+    """
+    batch = torch.from_numpy(tiles).to(device)
+    batch = batch.permute(0, 3, 1, 2).float().div_(255)
+    return vis_processors["eval"].normalize(batch)
 
 
 @dataclass
@@ -149,8 +381,194 @@ class Grid:
     tile_overlap_y: int = 56
 
 
-def get_tiles(grid, chunk_x, chunk_y):    
+def read_region(src, window):
+    """
+    Reads the first three bands of `window` as a HxWx3 array. Anything outside the raster is
+    filled with nodata as a boundless read would, but only the part inside is read, in a
+    single bounded call.
+    """
+    fill_value = src.nodata if src.nodata is not None else 0
+    region = np.full((3, window.height, window.width), fill_value, dtype=src.dtypes[0])
+
+    col_start, row_start = max(window.col_off, 0), max(window.row_off, 0)
+    col_stop = min(window.col_off + window.width, src.width)
+    row_stop = min(window.row_off + window.height, src.height)
+
+    if col_stop > col_start and row_stop > row_start:
+        src.read(
+            indexes=[1, 2, 3],
+            window=Window(col_start, row_start, col_stop - col_start, row_stop - row_start),
+            out=region[:, row_start - window.row_off:row_stop - window.row_off,
+                       col_start - window.col_off:col_stop - window.col_off],
+        )
+
+    return region.transpose(1, 2, 0)
+
+
+def get_strips(grid, chunk_x, chunk_y, first_row=0):
+    """
+    Splits the chunk from `first_row` on into strips of READ_TILE_ROWS rows of tiles, returning
+    (first_tile_y, num_rows) for each.
+    """
+    _, num_tiles_y = get_num_chunk_tiles(grid, chunk_x, chunk_y)
+    return [
+        (first_tile_y, min(read_tile_rows, num_tiles_y - first_tile_y))
+        for first_tile_y in range(first_row, num_tiles_y, read_tile_rows)
+    ]
+
+
+def read_strip(src, grid, chunk_x, chunk_y, first_tile_y, num_rows, offset=(0, 0)):
+    """
+    Reads a strip of `num_rows` rows of tiles of the chunk as a HxWx3 array. `offset` is where
+    `src` starts in the source raster, when it is a slice of it.
+
+    The strip covers the full width of the chunk and its overlap, so each source pixel is
+    decoded about once instead of once for each of the tiles that overlap it.
+    """
+    centre_width = grid.tile_width - grid.tile_overlap_x * 2
+    centre_height = grid.tile_height - grid.tile_overlap_y * 2
+
+    num_tiles_x, _ = get_num_chunk_tiles(grid, chunk_x, chunk_y)
+
+    x_offset = chunk_x * grid.tiles_x_per_chunk * centre_width
+    y_offset = chunk_y * grid.tiles_y_per_chunk * centre_height
+
+    return read_region(src, Window(
+        col_off=x_offset - grid.tile_overlap_x - offset[0],
+        row_off=y_offset + first_tile_y * centre_height - grid.tile_overlap_y - offset[1],
+        width=(num_tiles_x - 1) * centre_width + grid.tile_width,
+        height=(num_rows - 1) * centre_height + grid.tile_height,
+    ))
+
+
+def load_strip(src_file, offset, grid, chunk_x, chunk_y, first_tile_y, num_rows, prefilter, cache_prefix=None):
+    """
+    The CPU side of the pipeline, run in the read pool: reads a strip, drops the tiles that
+    `prefilter` catches, and looks the rest up in the tile cache when `cache_prefix` is given.
+
+    Returns (x_tile, y_tile, tile, key) for the tiles to score, the (x_tile, y_tile) of the
+    skipped tiles and of the tiles caught by the prefilter thresholds, and (x_tile, y_tile, scores)
+    for the tiles found in the cache.
+    """
+    centre_width = grid.tile_width - grid.tile_overlap_x * 2
+    centre_height = grid.tile_height - grid.tile_overlap_y * 2
+    num_tiles_x, _ = get_num_chunk_tiles(grid, chunk_x, chunk_y)
+
+    with rasterio.Env(**vfs_options), rasterio.open(src_file, "r") as src:
+        strip = read_strip(src, grid, chunk_x, chunk_y, first_tile_y, num_rows, offset)
+        # a mask leaves the pixels it hides at 0; without either, 0 is just black
+        if src.nodata is not None:
+            fill_value = src.nodata
+        elif any(MaskFlags.per_dataset in flags or MaskFlags.alpha in flags for flags in src.mask_flag_enums[:3]):
+            fill_value = 0
+        else:
+            fill_value = None
+
+    # statistics for every tile of the strip at once, before any tile is copied
+    empty, filtered = prefilter.apply(*tile_statistics(strip, grid, num_rows, num_tiles_x, fill_value))
+
+    skipped = [(x, first_tile_y + row) for row, x in zip(*np.nonzero(empty))]
+    caught = [(x, first_tile_y + row) for row, x in zip(*np.nonzero(filtered))]
+
+    tiles = []
+    cached = []
+    for row, x in zip(*np.nonzero(~(empty | filtered))):
+        img_data = strip[row * centre_height:row * centre_height + grid.tile_height,
+                         x * centre_width:x * centre_width + grid.tile_width]
+        key = None
+        if cache_prefix:
+            key = f"{cache_prefix}/{hash_tile(img_data, tile_cache_quantize_bits)}"
+            scores = tile_cache.get(key)
+            if scores is not None:
+                cached.append((int(x), first_tile_y + int(row), scores))
+                continue
+        tiles.append((int(x), first_tile_y + int(row), img_data, key))
+
+    return tiles, skipped, caught, cached
+
+
+def stack_batch(batch):
+    """
+    Turns a list of (x_tile, y_tile, tile, key) into the (tiles_x, tiles_y, tiles, keys) batch
+    the GPU stage takes.
+    """
+    tiles_x, tiles_y, tiles, keys = zip(*batch)
+    return list(tiles_x), list(tiles_y), np.stack(tiles), list(keys)
 
+
+@dataclass
+class Progress:
+    rows_done: int  # every tile above this row has been scored once the GPU gets here
+
+
+def run_on_gpu(process_batch, *batch):
+    global gpu_idle_seconds, gpu_last_busy
+
+    started = time.monotonic()
+    if gpu_last_busy is not None:
+        gpu_idle_seconds += started - gpu_last_busy
+    try:
+        process_batch(*batch)
+    finally:
+        gpu_last_busy = time.monotonic()
+
+
+async def run_pipeline(produce, process_batch, on_progress=None):
+    """
+    Runs `process_batch` on the GPU thread for every batch that `produce(queue)` puts in the
+    queue. The producer works ahead of the GPU by up to PREFETCH_BATCHES batches, so that
+    reading and preprocessing overlap with inference. The GPU thread is shared by every chunk
+    in flight, and takes their batches in turn. `on_progress` is awaited for each Progress
+    the producer puts between the batches.
+
+    Returns the number of seconds this chunk spent waiting for a batch to be read.
+    """
+    global gpu_last_busy, active_pipelines
+
+    queue = asyncio.Queue(maxsize=prefetch_batches)
+    loop = asyncio.get_running_loop()
+
+    # the GPU only counts as idle while there is a chunk it could be working on
+    if active_pipelines == 0:
+        gpu_last_busy = time.monotonic()
+    active_pipelines += 1
+
+    async def run_producer():
+        try:
+            await produce(queue)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    producer = asyncio.create_task(run_producer())
+    waited = 0.0
+    try:
+        while True:
+            waiting = loop.time()
+            batch = await queue.get()
+            waited += loop.time() - waiting
+
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            if isinstance(batch, Progress):
+                if on_progress is not None:
+                    await on_progress(batch.rows_done)
+                continue
+
+            await loop.run_in_executor(gpu_pool, run_on_gpu, process_batch, *batch)
+    finally:
+        producer.cancel()
+        active_pipelines -= 1
+        if active_pipelines == 0:
+            gpu_last_busy = None
+
+    return waited
+
+
+def get_num_chunk_tiles(grid, chunk_x, chunk_y):
     centre_width = grid.tile_width - grid.tile_overlap_x * 2
     centre_height = grid.tile_height - grid.tile_overlap_y * 2
 
@@ -160,19 +578,77 @@ def get_tiles(grid, chunk_x, chunk_y):
     num_tiles_x = min(grid.tiles_x_per_chunk, num_tiles_x - chunk_x * grid.tiles_x_per_chunk)
     num_tiles_y = min(grid.tiles_y_per_chunk, num_tiles_y - chunk_y * grid.tiles_y_per_chunk)
 
-    x_offset = chunk_x * grid.tiles_x_per_chunk * centre_width
-    y_offset = chunk_y * grid.tiles_y_per_chunk * centre_height
+    return num_tiles_x, num_tiles_y
+
+
+def get_dst_profile(grid, chunk_x, chunk_y, band_size, crs, transform, width, height):
+    centre_width = grid.tile_width - grid.tile_overlap_x * 2
+    centre_height = grid.tile_height - grid.tile_overlap_y * 2
+
+    x_offset = chunk_x * grid.tiles_x_per_chunk
+    y_offset = chunk_y * grid.tiles_y_per_chunk
+
+    num_tiles_x, num_tiles_y = get_num_chunk_tiles(grid, chunk_x, chunk_y)
+
+    dst_profile = {
+        "driver": "GTiff",
+        "width": min(num_tiles_x, (width - x_offset) // centre_width + 1),
+        "height": min(num_tiles_y, (height - y_offset) // centre_height + 1),
+        "count": band_size,
+        "dtype": np.float32,
+        "transform": transform  * Affine.scale(centre_width,centre_height) * Affine.translation(x_offset, y_offset),
+        "compress": "lzw"
+    }
+    if crs is not None:
+        dst_profile["crs"] = crs
+
+    return dst_profile
+
+
+def save_checkpoint(remote_file, scores, rows_done):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, scores=scores, rows_done=rows_done)
+    with open_fs(remote_fs_url) as fs:
+        fs.writebytes(remote_file, buffer.getvalue())
+
+
+def load_checkpoint(remote_file, shape):
+    """
+    Returns the scores and the number of rows of tiles done from a checkpoint, or None if there
+    isn't one that fits.
+    """
+    try:
+        with open_fs(remote_fs_url) as fs:
+            if not fs.exists(remote_file):
+                return None
+            checkpoint = np.load(io.BytesIO(fs.readbytes(remote_file)))
+    except Exception as e:
+        log.warning(f"Couldn't read checkpoint {remote_file}: {e}")
+        return None
+
+    if checkpoint["scores"].shape != shape:
+        return None
+    return checkpoint["scores"], int(checkpoint["rows_done"])
+
+
+def remove_checkpoint(remote_file):
+    with open_fs(remote_fs_url) as fs:
+        if fs.exists(remote_file):
+            fs.remove(remote_file)
+
+
+def write_scores(dst_file, dst_profile, scores):
+    with rasterio.open(dst_file, "w", **dst_profile) as dst:
+        dst.write(scores)
+
+
+def upload_file(local_file, remote_file):
+    with open(local_file, "rb") as f:
+        with open_fs(remote_fs_url) as fs:
+            with fs.open(remote_file, "wb") as dst:
+                shutil.copyfileobj(f, dst)
 
-    for tile_y in range(num_tiles_y):
-        for tile_x in range(num_tiles_x):
-            yield Window(
-                col_off=x_offset + tile_x * centre_width - grid.tile_overlap_x,
-                row_off=y_offset + tile_y * centre_height - grid.tile_overlap_y, 
-                width=grid.tile_width,
-                height=grid.tile_height
-            )
 
-        
 async def publish_chunk_result(chunk:Chunk, subject:str, id:str):
     payload = json.dumps(asdict(chunk)).encode()
     await worker.publish_msg(
@@ -181,8 +657,55 @@ async def publish_chunk_result(chunk:Chunk, subject:str, id:str):
             id=id
     )
 
-@worker.background_consumer(subject="chunk.new", ack_wait=3600)
+
+async def publish_chunk_progress(chunk: Chunk, tiles_done: int, tiles_total: int):
+    chunk_x, chunk_y = chunk.chunk
+    await worker.publish_msg(
+        packb({
+            "id": chunk.id,
+            "chunk": chunk.chunk,
+            "dispatch": chunk.dispatch,
+            "tiles_done": tiles_done,
+            "tiles_total": tiles_total,
+        }),
+        subject="chunk.progress",
+        id=f"chunk.progress.{chunk.id}/{chunk_x},{chunk_y}.{chunk.dispatch}.{tiles_done}"
+    )
+
+
+async def report_progress(chunk: Chunk, tiles_done, tiles_total: int):
+    """
+    Publishes `tiles_done()` every PROGRESS_SECONDS while it keeps going up, so a chunk that has
+    stopped making progress goes quiet.
+    """
+    reported = tiles_done()
+    while True:
+        await asyncio.sleep(progress_seconds)
+        done = tiles_done()
+        if done != reported:
+            await publish_chunk_progress(chunk, done, tiles_total)
+            reported = done
+
+
+async def keep_in_progress(msg):
+    """
+    Tells the server every so often that the chunk is still being worked on, so that a chunk
+    waiting its turn for the GPU behind the others isn't redelivered.
+    """
+    while True:
+        await asyncio.sleep(chunk_ack_wait / 3)
+        await msg.in_progress()
+
+
 async def process_chunks(msg):
+    heartbeat = asyncio.create_task(keep_in_progress(msg))
+    try:
+        await process_chunk(msg)
+    finally:
+        heartbeat.cancel()
+
+
+async def process_chunk(msg):
     data = unpackb(msg.data)
     request = Chunk(**json.loads(data))
 
@@ -200,116 +723,267 @@ async def process_chunks(msg):
         subquestions = questionset
         path = ""
 
-        src_file = os.path.join(cache_dir, id, "src.tif")
-        await download_and_cache(remote_file, src_file)
-
-        log.info(f"processing batch for {remote_file}")
-
-        with rasterio.open(src_file, "r") as src:
-            crs = src.crs
-            dst_file = f"{cache_dir}/{id}/dst-{chunk_x}-{chunk_y}-{attempt}.tif"
-
-            centre_width = grid.tile_width - grid.tile_overlap_x * 2
-            centre_height = grid.tile_height - grid.tile_overlap_y * 2
+        # a chunk sent out again because it fell behind gets its own output
+        dst_name = f"dst-{chunk_x}-{chunk_y}-{attempt}" + (f"-{request.dispatch}" if request.dispatch else "")
+        dst_file = f"{cache_dir}/{id}/{dst_name}.tif"
+        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+
+        chunk_decoding = request.decoding or decoding
+        if chunk_decoding not in decoding_modes:
+            log.warning(f"Unknown decoding {chunk_decoding} for {id}, using {decoding}")
+            chunk_decoding = decoding
+
+        prefilter_settings = request.prefilter or {}
+        unknown_settings = set(prefilter_settings) - {f.name for f in fields(Prefilter)}
+        if unknown_settings:
+            log.warning(f"Ignoring unknown prefilter settings {sorted(unknown_settings)} for {id}")
+        prefilter = Prefilter(**{k: v for k, v in prefilter_settings.items() if k not in unknown_settings})
+        # score given to tiles caught by the prefilter, 0 unless the questionset sets one
+        filtered_scores = np.array([float((prefilter.scores or {}).get(k, 0.0)) for k in effectset],
+                                   dtype=np.float32)
+
+        store = None
+        # a second dispatch could land on the same predictor as the first, so it leaves the store alone
+        if (embedding_dir and request.hash is not None and request.size is not None and model is not None
+                and not request.dispatch):
+            window = (chunk_x * grid.tiles_x_per_chunk, chunk_y * grid.tiles_y_per_chunk,
+                      *get_num_chunk_tiles(grid, chunk_x, chunk_y))
+            store = EmbeddingStore(embedding_dir, request.hash, request.size, model_size, grid, window,
+                                   prefilter.key())
+            if not store.is_complete() and embedding_remote:
+                with open_fs(remote_fs_url) as fs:
+                    await asyncio.to_thread(store.download, fs)
+
+        filtered_tiles = 0
+        src_file = None
+        # each dispatch of a chunk keeps its own, so one finishing doesn't remove what another resumes from
+        remote_checkpoint_file = os.path.join(
+            id, f"ckpt-{chunk_x}-{chunk_y}" + (f"-{request.dispatch}" if request.dispatch else "") + ".npz")
+        first_row = 0
+
+        # tiles sharing their pixels with an earlier tile of the chunk, as (x, y, earlier x, earlier y)
+        duplicates = []
+        cache_prefix = None
+        # only answers that come out the same every time can be reused, and a store being built
+        # needs every tile encoded
+        if tile_cache is not None and model is not None and store is None and chunk_decoding in ("greedy", "score"):
+            questionset_hash = hashlib.blake2b(
+                json.dumps([questionset, effectset], sort_keys=True).encode(), digest_size=8).hexdigest()
+            cache_prefix = f"{model_size}/{chunk_decoding}/{questionset_hash}"
+        cached_tiles = 0
+
+        def score_batch(scores, tiles_x, tiles_y, query_embeds):
+            results = evaluate_questionset(subquestions, effectset, effects_dict, len(tiles_x),
+                                           functools.partial(answer_questions, query_embeds, mode=chunk_decoding),
+                                           path)
+
+            for x_tile, y_tile, result in zip(tiles_x, tiles_y, results):
+                for band, v in enumerate(result.values()):
+                    scores[band, y_tile, x_tile] = float(v['score'])
+
+        rescoring = store is not None and store.is_complete()
+        if rescoring:
+            log.info(f"re-scoring {id}/{chunk_x},{chunk_y} from stored embeddings")
+
+            meta = store.open()
+            crs = rasterio.CRS.from_wkt(meta["crs"]) if meta["crs"] is not None else None
+            dst_profile = get_dst_profile(grid, chunk_x, chunk_y, band_size, crs,
+                                          Affine.from_gdal(*meta["transform"]), meta["width"], meta["height"])
+            scores = np.zeros((band_size, dst_profile["height"], dst_profile["width"]), dtype=np.float32)
+
+            filtered_y, filtered_x = np.nonzero(store.states == EmbeddingStore.FILTERED)
+            scores[:, filtered_y, filtered_x] = filtered_scores[:, None]
+            filtered_tiles = len(filtered_x)
+
+            tiles_total = store.states.size
+            tiles_done = tiles_total - int(np.count_nonzero(store.states == EmbeddingStore.EMBEDDED))
+
+            def load_embeddings(tiles_x, tiles_y):
+                return tiles_x.tolist(), tiles_y.tolist(), store.read(tiles_y, tiles_x)
+
+            async def produce(queue):
+                embedded_y, embedded_x = np.nonzero(store.states == EmbeddingStore.EMBEDDED)
+                for i in range(0, len(embedded_x), batch_size):
+                    batch = await asyncio.get_running_loop().run_in_executor(
+                        read_pool, load_embeddings, embedded_x[i:i + batch_size], embedded_y[i:i + batch_size])
+                    await queue.put(batch)
+
+            def process_batch(tiles_x, tiles_y, queries):
+                nonlocal tiles_done
+                query_embeds = project_queries(torch.from_numpy(queries).to(device))
+                score_batch(scores, tiles_x, tiles_y, query_embeds)
+                tiles_done += len(tiles_x)
+
+            # re-scoring is quick, so it isn't checkpointed
+            on_progress = None
+
+        else:
+            # a slice of the source is read where the web worker made one
+            src_file = await file_cache.locate(request.chunk_file or remote_file)
+            offset = request.chunk_offset or [0, 0]
+
+            log.info(f"processing batch for {remote_file} from {src_file}")
+
+            with rasterio.Env(**vfs_options), rasterio.open(src_file, "r") as src:
+                transform = src.transform * Affine.translation(-offset[0], -offset[1])
+                dst_profile = get_dst_profile(grid, chunk_x, chunk_y, band_size, src.crs,
+                                              transform, grid.raster_width, grid.raster_height)
+                meta = {
+                    "crs": src.crs.to_wkt() if src.crs is not None else None,
+                    "transform": list(transform.to_gdal()),
+                    "width": grid.raster_width,
+                    "height": grid.raster_height,
+                }
 
-            x_offset = chunk_x * grid.tiles_x_per_chunk 
-            y_offset = chunk_y * grid.tiles_y_per_chunk
+            # (bands, tiles_y, tiles_x) scores for the whole chunk, written out in one go at the end
+            scores = np.zeros((band_size, dst_profile["height"], dst_profile["width"]), dtype=np.float32)
+
+            checkpoint = await asyncio.to_thread(load_checkpoint, remote_checkpoint_file, scores.shape)
+            if checkpoint is not None:
+                scores, first_row = checkpoint
+                log.info(f"Resuming {id}/{chunk_x},{chunk_y} from row {first_row}")
+                # the rows already done weren't encoded in this attempt
+                if store is not None:
+                    await asyncio.to_thread(store.discard)
+                    store = None
+
+            if store is not None:
+                store.create()
+
+            num_tiles_x, num_tiles_y = get_num_chunk_tiles(grid, chunk_x, chunk_y)
+            tiles_total = num_tiles_x * num_tiles_y
+            tiles_done = first_row * num_tiles_x
+
+            async def produce(queue):
+                nonlocal filtered_tiles, cached_tiles, tiles_done
+                loop = asyncio.get_running_loop()
+                pending = []
+                strips = get_strips(grid, chunk_x, chunk_y, first_row)
+                batch = []
+                first_seen = {}
+                rows_done = first_row
+
+                # keep up to READ_WORKERS strips being read, and hand them on in order
+                for i in range(len(strips)):
+                    while len(pending) < read_workers and i + len(pending) < len(strips):
+                        first_tile_y, num_rows = strips[i + len(pending)]
+                        pending.append(loop.run_in_executor(
+                            read_pool, load_strip, src_file, offset, grid, chunk_x, chunk_y, first_tile_y, num_rows,
+                            prefilter, cache_prefix))
+
+                    tiles, skipped, caught, cached = await pending.pop(0)
+                    for x_tile, y_tile in caught:
+                        scores[:, y_tile, x_tile] = filtered_scores
+                    if store is not None:
+                        for x_tile, y_tile in skipped:
+                            store.skip(y_tile, x_tile)
+                        for x_tile, y_tile in caught:
+                            store.skip(y_tile, x_tile, EmbeddingStore.FILTERED)
+                    filtered_tiles += len(caught)
+                    for x_tile, y_tile, tile_scores in cached:
+                        scores[:, y_tile, x_tile] = tile_scores
+                    cached_tiles += len(cached)
+                    tiles_done += len(skipped) + len(caught) + len(cached)
+
+                    for x_tile, y_tile, img_data, key in tiles:
+                        if key is not None:
+                            if key in first_seen:
+                                duplicates.append((x_tile, y_tile, *first_seen[key]))
+                                tiles_done += 1
+                                continue
+                            first_seen[key] = (x_tile, y_tile)
+
+                        batch.append((x_tile, y_tile, img_data, key))
+                        if len(batch) == batch_size:
+                            await queue.put(stack_batch(batch))
+                            batch = []
+
+                    # rows with tiles still waiting for a batch to fill up aren't done yet
+                    first_tile_y, num_rows = strips[i]
+                    strip_done = batch[0][1] if batch else first_tile_y + num_rows
+                    if strip_done > rows_done:
+                        rows_done = strip_done
+                        await queue.put(Progress(rows_done))
+
+                if batch:
+                    await queue.put(stack_batch(batch))
+
+            def process_batch(tiles_x, tiles_y, tiles, keys):
+                nonlocal tiles_done
+                if model is None:
+                    score_batch(scores, tiles_x, tiles_y, None)
+                    tiles_done += len(tiles_x)
+                    return
+
+                # the vision encoder runs once per tile here, not once per question
+                queries = encode_queries(preprocess_tiles(tiles))
+                if store is not None:
+                    store.write(tiles_y, tiles_x, queries.half().cpu().numpy())
+                score_batch(scores, tiles_x, tiles_y, project_queries(queries))
+
+                if cache_prefix is not None:
+                    tile_cache.put_many(keys, scores[:, tiles_y, tiles_x].T)
+                tiles_done += len(tiles_x)
+
+            last_checkpoint = asyncio.get_running_loop().time()
+
+            async def on_progress(rows_done):
+                nonlocal last_checkpoint
+                if asyncio.get_running_loop().time() - last_checkpoint < checkpoint_seconds:
+                    return
+
+                checkpoint_scores = scores.copy()
+                for x_tile, y_tile, first_x, first_y in duplicates:
+                    checkpoint_scores[:, y_tile, x_tile] = checkpoint_scores[:, first_y, first_x]
+                await asyncio.to_thread(save_checkpoint, remote_checkpoint_file, checkpoint_scores, rows_done)
+                last_checkpoint = asyncio.get_running_loop().time()
+                log.info(f"Saved checkpoint for {id}/{chunk_x},{chunk_y} at row {rows_done}")
+
+        await publish_chunk_progress(request, tiles_done, tiles_total)
+        reporter = asyncio.create_task(report_progress(request, lambda: tiles_done, tiles_total))
+
+        started = asyncio.get_running_loop().time()
+        try:
+            waited = await run_pipeline(produce, process_batch, on_progress)
+        finally:
+            reporter.cancel()
+            if src_file is not None:
+                file_cache.release(src_file)
+        log.info(f"Chunk {id}/{chunk_x},{chunk_y} took {asyncio.get_running_loop().time() - started:.1f}s, "
+                 f"{filtered_tiles} tiles caught by the prefilter, "
+                 f"waited {waited:.1f}s for reads, GPU idle for {gpu_idle_seconds:.1f}s in total")
+
+        for x_tile, y_tile, first_x, first_y in duplicates:
+            scores[:, y_tile, x_tile] = scores[:, first_y, first_x]
+
+        if cache_prefix is not None:
+            log.info(f"Tile cache for {id}/{chunk_x},{chunk_y}: {cached_tiles} hits, "
+                     f"{len(duplicates)} duplicates within the chunk "
+                     f"({tile_cache.hits} hits, {tile_cache.misses} misses in total)")
+
+        if store is not None and not rescoring:
+            await asyncio.to_thread(store.finish, meta)
+            if embedding_remote:
+                with open_fs(remote_fs_url) as fs:
+                    await asyncio.to_thread(store.upload, fs)
 
+        await asyncio.to_thread(write_scores, dst_file, dst_profile, scores)
 
-            num_tiles_x = (grid.raster_width + centre_width - 1) // centre_width
-            num_tiles_y = (grid.raster_height + centre_height - 1) // centre_height
+        # Upload to remote fs
+        remote_dst_file = os.path.join(id, f"{dst_name}.tif")
 
-            num_tiles_x = min(grid.tiles_x_per_chunk, num_tiles_x - chunk_x * grid.tiles_x_per_chunk)
-            num_tiles_y = min(grid.tiles_y_per_chunk, num_tiles_y - chunk_y * grid.tiles_y_per_chunk)
-            
-            if crs is not None:
-                dst_profile = {
-                    "driver": "GTiff",
-                    "width": min(num_tiles_x, (src.width - x_offset) // centre_width + 1), 
-                    "height": min(num_tiles_y, (src.height - y_offset) // centre_height + 1),
-                    "count": band_size,
-                    "dtype": np.float32,
-                    "crs": crs,
-                    "transform": src.transform  * Affine.scale(centre_width,centre_height) * Affine.translation(x_offset, y_offset),
-                    "compress": "lzw"
-                }
+        log.info(f"Uploading file {remote_dst_file}")
+        await asyncio.to_thread(upload_file, dst_file, remote_dst_file)
+        log.info(f"Sending message {remote_dst_file}")
+        # Overwrite request chunk object's file (id/src.tif) with dst file
+        request.file = remote_dst_file
+        await publish_chunk_result(request,
+                                   subject="chunk.result",
+                                   id=f"chunk.result.{id}/{chunk_x},{chunk_y}"
+                                      + (f".{request.dispatch}" if request.dispatch else ""))
+        log.info(f"Message send {remote_dst_file}")
 
-            else:
-                dst_profile = {
-                    "driver": "GTiff",
-                    "width": min(num_tiles_x, (src.width - x_offset) // centre_width + 1), 
-                    "height": min(num_tiles_y, (src.height - y_offset) // centre_height + 1),
-                    "count": band_size,
-                    "dtype": np.float32,
-                    "transform": src.transform  * Affine.scale(centre_width,centre_height) * Affine.translation(x_offset, y_offset),
-                    "compress": "lzw"
-                }
-
-            with rasterio.open(
-                    dst_file,
-                    "w",
-                    **dst_profile) as dst:
-                for window in get_tiles(grid, chunk_x, chunk_y):
-        
-                    await asyncio.sleep(0)
-
-                    img_data = src.read(
-                        window=window,
-                        boundless=True,
-                        fill_value=src.nodata,
-                    )[:3, :, :].transpose(1, 2, 0)
-
-                    if np.all(img_data == src.nodata):
-                        continue
-
-                    img = Image.fromarray(
-                        img_data
-                    )
-
-                    img_features = (
-                        vis_processors["eval"](img)
-                        .unsqueeze(0)
-                        .to("cuda")
-                    ) if model is not None else None
-
-                    effectset_ = effectset.copy() # just to be sure not to be referenced inside recursive.
-                    effects_dict_ = effects_dict.copy() 
-                    result = explore_questionset(img_features, subquestions, path, effectset_, effects_dict_)
-                    scores = [ v['score'] for k, v in result.items()]
-
-                    x_tile = (window.col_off + grid.tile_overlap_x) // centre_width - grid.tiles_x_per_chunk * chunk_x
-                    y_tile = (window.row_off + grid.tile_overlap_y) // centre_height - grid.tiles_y_per_chunk * chunk_y
-
-                    for i in range(band_size):
-                        if scores[i]==0:
-                            continue
-                        
-                        dst.write(
-                            np.array([[scores[i]]]),
-                            i+1, # band_index from 1,
-                            window=Window(
-                                x_tile, 
-                                y_tile,
-                                1,
-                                1,
-                            ),
-                        )
-
-            # Upload to remote fs
-            remote_dst_file = os.path.join(id, f"dst-{chunk_x}-{chunk_y}-{attempt}.tif")
-
-            log.info(f"Uploading file {remote_dst_file}")
-            with open(dst_file, "rb") as f:
-                with open_fs(remote_fs_url) as fs:
-                    with fs.open(remote_dst_file, "wb") as dst:
-                        shutil.copyfileobj(f, dst)
-            log.info(f"Sending message {remote_dst_file}")
-            # Overwrite request chunk object's file (id/src.tif) with dst file
-            request.file = remote_dst_file
-            await publish_chunk_result(request, 
-                                    subject="chunk.result", 
-                                    id=f"chunk.result.{id}/{chunk_x},{chunk_y}")
-            log.info(f"Message send {remote_dst_file}")
+        await asyncio.to_thread(remove_checkpoint, remote_checkpoint_file)
 
     else:
         # fail the process as it has attempted 5 times already
@@ -319,6 +993,12 @@ async def process_chunks(msg):
                                 id=f"chunk.failed.{id}/{chunk_x},{chunk_y}")
 
 
+# each consumer takes one message at a time and only fetches the next once it is done, so a
+# predictor never holds more than MAX_INFLIGHT_CHUNKS chunks. They all share the GPU thread.
+for _ in range(max_inflight_chunks):
+    worker.background_consumer(subject="chunk.new", name="process_chunks", ack_wait=chunk_ack_wait)(process_chunks)
+
+
 async def delete_temp(id:str):
     try:
         path = os.path.join(cache_dir, id)
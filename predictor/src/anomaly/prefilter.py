@@ -0,0 +1,106 @@
+import hashlib
+import json
+import math
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+
+import numpy as np
+
+
+@dataclass
+class Prefilter:
+    """
+    Thresholds for tiles that are not worth asking the model about, set per questionset under
+    `prefilter`. Tiles that are nodata throughout are always skipped, but only rasters that
+    declare nodata or a mask have any. Tiles caught by the thresholds are skipped too, or given
+    `scores` instead when it is set. Black is a colour like any other in rasters without nodata,
+    so black tiles are only caught by `colours` or `min_variance`.
+    """
+    min_valid_fraction: float = 0.0  # of pixels that are not nodata
+    min_variance: float = 0.0  # of the valid pixels, averaged over the bands
+    colours: list = field(default_factory=list)  # [r, g, b] colours to filter out, like open water or cloud
+    colour_tolerance: float = 0.0  # how far the mean colour of a tile may be from one of `colours`
+    scores: Optional[dict] = None  # effect name to score for filtered tiles
+
+    def key(self):
+        """
+        Identifies the thresholds, so that embeddings stored under one set are not reused with another.
+        Empty for the defaults.
+        """
+        thresholds = asdict(self)
+        defaults = asdict(Prefilter())
+        del thresholds["scores"], defaults["scores"]
+        if thresholds == defaults:
+            return ""
+        return hashlib.blake2b(json.dumps(thresholds, sort_keys=True).encode(), digest_size=4).hexdigest()
+
+    def apply(self, valid_fraction, mean, variance):
+        """
+        Returns boolean masks of the tiles to skip and the tiles caught by the thresholds.
+        """
+        empty = valid_fraction == 0
+        filtered = (valid_fraction < self.min_valid_fraction) | (variance < self.min_variance)
+        for colour in self.colours:
+            filtered |= np.all(np.abs(mean - np.asarray(colour, dtype=np.float32)) <= self.colour_tolerance, axis=-1)
+        return empty, filtered & ~empty
+
+
+def window_sums(block_sums, step_y, step_x, size_y, size_x, num_rows, num_cols):
+    """
+    Sums `size_y` x `size_x` windows of blocks, starting every `step_y` and `step_x` blocks,
+    using a summed-area table over the first two axes.
+    """
+    table = block_sums.cumsum(axis=0).cumsum(axis=1)
+    table = np.pad(table, [(1, 0), (1, 0)] + [(0, 0)] * (block_sums.ndim - 2))
+    y0, x0 = np.ix_(np.arange(num_rows) * step_y, np.arange(num_cols) * step_x)
+    y1, x1 = y0 + size_y, x0 + size_x
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+
+def tile_statistics(strip, grid, num_rows, num_cols, fill_value):
+    """
+    Returns the fraction of valid pixels, the mean colour and the variance of the valid pixels
+    for every tile of a HxWx3 strip, with shapes (rows, cols), (rows, cols, 3) and (rows, cols).
+    Pixels equal to `fill_value` in every band are not valid; all of them are when it is None.
+
+    Pixels are summed once per block, with blocks sized to line up with both the tiles and the
+    steps between them, so the overlap between tiles is not summed twice.
+    """
+    centre_width = grid.tile_width - grid.tile_overlap_x * 2
+    centre_height = grid.tile_height - grid.tile_overlap_y * 2
+    block_width = math.gcd(centre_width, grid.tile_width)
+    block_height = math.gcd(centre_height, grid.tile_height)
+
+    height, width, bands = strip.shape
+    blocks_y, blocks_x = height // block_height, width // block_width
+
+    counts = np.zeros((blocks_y, blocks_x), dtype=np.float64)
+    sums = np.zeros((blocks_y, blocks_x, bands), dtype=np.float64)
+    squares = np.zeros((blocks_y, blocks_x, bands), dtype=np.float64)
+
+    # a row of blocks at a time keeps the float copies small
+    for block_y in range(blocks_y):
+        row = strip[block_y * block_height:(block_y + 1) * block_height, :blocks_x * block_width]
+        row = row.reshape(block_height, blocks_x, block_width, bands)
+        if fill_value is None:
+            valid = np.ones(row.shape[:-1], dtype=bool)
+        else:
+            valid = np.any(row != fill_value, axis=-1)
+        values = np.where(valid[..., None], row, 0).astype(np.float32)
+
+        counts[block_y] = valid.sum(axis=(0, 2))
+        sums[block_y] = values.sum(axis=(0, 2), dtype=np.float64)
+        squares[block_y] = (values * values).sum(axis=(0, 2), dtype=np.float64)
+
+    window = (centre_height // block_height, centre_width // block_width,
+              grid.tile_height // block_height, grid.tile_width // block_width, num_rows, num_cols)
+    count = window_sums(counts, *window)
+    total = window_sums(sums, *window)
+    total_squares = window_sums(squares, *window)
+
+    valid_fraction = count / (grid.tile_width * grid.tile_height)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / count[..., None]
+        variance = np.maximum(total_squares / count[..., None] - mean * mean, 0).mean(axis=-1)
+
+    return valid_fraction, mean, variance
@@ -0,0 +1,72 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def hash_tile(tile, quantize_bits=0):
+    """
+    Hashes the pixels of a tile. Dropping the `quantize_bits` lowest bits of each value first
+    lets near-identical tiles, like compression noise over open water, share a hash.
+    """
+    if quantize_bits:
+        tile = tile >> quantize_bits
+    return hashlib.blake2b(np.ascontiguousarray(tile).data, digest_size=16).hexdigest()
+
+
+class TileCache:
+    """
+    LRU cache of the scores given to a tile, keyed by its content and by what it was asked, with
+    an optional SQLite tier on disk that outlives the process. Safe to share between threads.
+    """
+
+    def __init__(self, max_entries, path=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tiles (key TEXT PRIMARY KEY, scores BLOB NOT NULL)")
+
+    def _remember(self, key, scores):
+        self.entries[key] = scores
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            scores = self.entries.get(key)
+            if scores is not None:
+                self.entries.move_to_end(key)
+            elif self.db is not None:
+                row = self.db.execute("SELECT scores FROM tiles WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    scores = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, scores)
+
+            if scores is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return scores
+
+    def put_many(self, keys, scores):
+        rows = [(key, np.asarray(s, dtype=np.float32)) for key, s in zip(keys, scores)]
+        with self.lock:
+            for key, s in rows:
+                self._remember(key, s)
+            if self.db is not None:
+                self.db.execute("BEGIN")
+                self.db.executemany("INSERT OR REPLACE INTO tiles (key, scores) VALUES (?, ?)",
+                                    [(key, s.tobytes()) for key, s in rows])
+                self.db.execute("COMMIT")
@@ -10,6 +10,7 @@ resource "jetstream_stream" "rasters" {
     "chunk.new",
     "chunk.failed",
     "chunk.result",
+    "chunk.progress",
     "result.new",
     "result.tiled"
   ]
@@ -87,6 +88,16 @@ resource "jetstream_consumer" "web_record_chunk_result" {
   sample_freq    = "100"
 }
 
+resource "jetstream_consumer" "web_record_chunk_progress" {
+  stream_id      = jetstream_stream.rasters.id
+  durable_name   = "web_record_chunk_progress"
+  description    = "Records how far each chunk has got, to find the slow ones."
+  deliver_all    = true
+  ack_policy     = "explicit"
+  filter_subject = "chunk.progress"
+  sample_freq    = "100"
+}
+
 resource "jetstream_consumer" "web_catch_failed_chunks" {
   stream_id      = jetstream_stream.rasters.id
   durable_name   = "web_catch_failed_chunks"
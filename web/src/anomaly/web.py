@@ -1,4 +1,6 @@
 import asyncio
+import fcntl
+import glob
 import os
 import json
 import re
@@ -8,6 +10,7 @@ from io import BytesIO
 import random
 import sys
 from types import SimpleNamespace
+from typing import Optional
 
 from fastapi import FastAPI, UploadFile, Form, Query, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse
@@ -25,9 +28,9 @@ import signal
 
 from starlette.staticfiles import StaticFiles
 
-from .background import Raster, worker, remote_fs, remote_fs_url, cache_dir, container, \
-                        open_db_cursor, generate_id, extract_values, publish_new_raster, \
-                        delete_temp, log_dir 
+from .background import Raster, worker, remote_fs, cache_dir, \
+                        open_db_cursor, db_pool, generate_id, extract_values, publish_new_raster, \
+                        upload_and_hash, file_cache, set_raster_status, delete_temp, log_dir 
 
 
 from .logger import CustomLogger
@@ -37,6 +40,17 @@ log = CustomLogger.setup_logger(__name__, save_to_disk=True, log_dir=log_dir)
 
 schema_names = {}
 
+# members of an uploaded zip streamed to remote storage at once
+zip_workers = int(os.getenv("ZIP_WORKERS", default=4))
+# uploaded members recorded and published this many at a time
+zip_batch_size = int(os.getenv("ZIP_BATCH_SIZE", default=50))
+# zip uploads still being ingested, kept so that their tasks aren't garbage collected
+ingest_tasks = set()
+# written next to each uploaded archive, naming the member each of its rasters comes from
+members_name = ".members.json"
+# locked by the process ingesting the archive next to it
+lock_name = ".ingest.lock"
+
 id_regex = re.compile(r"^[a-zA-Z0-9_-]+$")
 
 src =  "src.tif"
@@ -87,6 +101,12 @@ async def app_lifespan(app):
             log.info("Worker exited unexpectedly")
             os.kill(pid, signal.SIGINT)
 
+    log.debug("Opening database pool")
+
+    await db_pool.open()
+
+    await resume_ingests()
+
     log.debug("Starting worker")
 
     task = await worker.start_as_task()
@@ -96,6 +116,8 @@ async def app_lifespan(app):
 
     yield
 
+    await db_pool.close()
+
 app = FastAPI(lifespan=app_lifespan)
 
 @app.websocket("/ws")
@@ -135,89 +157,280 @@ async def delete_temp(id:str):
     except Exception as e:
         log.error(f"Failed to delete temp folder '{path}' after processing: {e}")
 
+
+def list_zip_members(archive_file):
+    with zipfile.ZipFile(archive_file, "r") as archive:
+        # folders, and the resource forks macOS adds, aren't rasters
+        return [info.filename for info in archive.infolist()
+                if not info.is_dir() and not info.filename.startswith("__MACOSX/")]
+
+
+def upload_member(archive_file, member, remote_file):
+    remote_fs.makedirs(os.path.dirname(remote_file), recreate=True)
+    # each upload opens the archive itself, as reads through one ZipFile can't run in parallel
+    with zipfile.ZipFile(archive_file, "r") as archive, archive.open(member) as src:
+        return upload_and_hash(src, remote_file)
+
+
+async def ingest_zip(archive_file, folder_id, members, lock, recorded=()):
+    """
+    Streams the members of an uploaded archive to remote storage, ZIP_WORKERS at a time,
+    then records and publishes them ZIP_BATCH_SIZE at a time, along with the `recorded`
+    rasters that were uploaded before but not yet sent. Members that can't be uploaded,
+    recorded or sent are marked invalid. `lock` is held until the archive is removed.
+    """
+    queue = asyncio.Queue()
+    for member, raster in members:
+        queue.put_nowait((member, raster))
+    uploaded = list(recorded)
+    failed = []
+
+    async def flush():
+        batch = uploaded[:]
+        uploaded.clear()
+        if not batch:
+            return
+        try:
+            # the hash is stored with the marker that the raster is still to be sent, so a
+            # restart between the two sends it again
+            async with open_db_cursor() as cursor:
+                await cursor.executemany("UPDATE raster SET hash = %s, size = %s, ingest = 'publish' WHERE id = %s",
+                                         [(raster.hash, raster.size, raster.id) for raster in batch])
+        except Exception:
+            log.exception(f"Failed to record {len(batch)} rasters from {folder_id}")
+            failed.extend(raster.id for raster in batch)
+            return
+
+        # published together rather than waiting for each acknowledgement in turn
+        results = await asyncio.gather(
+            *(publish_new_raster(raster, subject="raster.new", id=f"raster.new.{raster.id}") for raster in batch),
+            return_exceptions=True)
+
+        sent = []
+        for raster, result in zip(batch, results):
+            if isinstance(result, Exception):
+                log.error(f"Failed to send {raster.id} from {folder_id} for indexing: {result}")
+                failed.append(raster.id)
+            else:
+                sent.append(raster.id)
+
+        if sent:
+            async with open_db_cursor() as cursor:
+                await cursor.execute("UPDATE raster SET ingest = NULL WHERE id = ANY(%s)", (sent,))
+        log.info(f"Sent {len(sent)} rasters from {folder_id} for indexing")
+
+    async def upload_members():
+        while not queue.empty():
+            member, raster = queue.get_nowait()
+            try:
+                raster.hash, raster.size = await asyncio.to_thread(upload_member, archive_file, member, raster.file)
+            except Exception:
+                log.exception(f"Failed to upload {member} from {folder_id}")
+                failed.append(raster.id)
+                continue
+
+            uploaded.append(raster)
+            if len(uploaded) >= zip_batch_size:
+                await flush()
+
+    try:
+        await asyncio.gather(*(upload_members() for _ in range(zip_workers)))
+        await flush()
+
+        if failed:
+            await mark_invalid(failed, "UPLOAD_FAILED")
+
+        log.info(f"Uploaded {len(members) - len(failed)} of {len(members)} files from {folder_id}")
+        await delete_temp(folder_id)
+    except Exception:
+        # the archive is kept, so the next start can carry on from the rasters still marked
+        log.exception(f"Failed to ingest {folder_id}")
+    finally:
+        lock.close()
+
+
+async def mark_invalid(ids, reason):
+    async with open_db_cursor() as cursor:
+        await cursor.executemany(
+            "INSERT INTO raster_invalid (raster, reason) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            [(id, reason) for id in ids])
+        await cursor.execute("UPDATE raster SET ingest = NULL WHERE id = ANY(%s)", (list(ids),))
+        for id in ids:
+            await set_raster_status(cursor, id, "Invalid")
+
+
+def lock_ingest(folder_id):
+    """
+    Takes the lock a process holds on an uploaded archive while ingesting it, so that no other
+    process sharing the cache picks it up. Returns None if another process has it.
+    """
+    try:
+        lock = open(os.path.join(cache_dir, folder_id, lock_name), "a")
+    except OSError:
+        return None
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def start_ingest(archive_file, folder_id, members, lock, recorded=()):
+    task = asyncio.create_task(ingest_zip(archive_file, folder_id, members, lock, recorded))
+    ingest_tasks.add(task)
+    task.add_done_callback(ingest_tasks.discard)
+
+
+def save_members(archive_file, folder_id, members):
+    with open(os.path.join(cache_dir, folder_id, members_name), "w") as f:
+        json.dump({"archive": archive_file, "members": {raster.id: member for member, raster in members}}, f)
+
+
+def load_members(folder_id):
+    """
+    Returns the archive of an upload and the member each of its rasters comes from, or None if
+    the archive is gone.
+    """
+    try:
+        with open(os.path.join(cache_dir, folder_id, members_name), "r") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return saved if os.path.exists(saved["archive"]) else None
+
+
+async def resume_ingests():
+    """
+    Carries on with the zip uploads that were still being ingested when the service stopped.
+    Only uploads kept in this process's cache, and that no other process is ingesting, are
+    picked up. Members that weren't uploaded before their archive went are marked invalid.
+    """
+    for members_file in glob.glob(os.path.join(cache_dir, "*", members_name)):
+        folder_id = os.path.basename(os.path.dirname(members_file))
+        lock = await asyncio.to_thread(lock_ingest, folder_id)
+        if lock is None:
+            continue
+
+        try:
+            async with open_db_cursor() as cursor:
+                await cursor.execute(
+                    "SELECT id, name, file, questionset_id, hash, size, ingest FROM raster "
+                    "WHERE folder_id = %s AND ingest IS NOT NULL",
+                    (folder_id,))
+                rows = await cursor.fetchall()
+
+            saved = await asyncio.to_thread(load_members, folder_id)
+            members = saved["members"] if saved is not None else {}
+
+            def to_raster(row):
+                return Raster(id=row["id"], name=row["name"], file=row["file"],
+                              questionset_id=row["questionset_id"], hash=row["hash"], size=row["size"])
+
+            lost = [row["id"] for row in rows if row["ingest"] == "upload" and row["id"] not in members]
+            if lost:
+                log.warning(f"Marking {len(lost)} rasters from {folder_id} invalid, their archive is gone")
+                await mark_invalid(lost, "UPLOAD_INTERRUPTED")
+
+            pending = [(members[row["id"]], to_raster(row))
+                       for row in rows if row["ingest"] == "upload" and row["id"] in members]
+            recorded = [to_raster(row) for row in rows if row["ingest"] == "publish"]
+        except Exception:
+            lock.close()
+            raise
+
+        if pending or recorded:
+            log.info(f"Resuming {folder_id}: uploading {len(pending)} rasters, sending {len(recorded)}")
+            start_ingest(saved["archive"] if saved is not None else None, folder_id, pending, lock, recorded)
+        else:
+            # every member was uploaded and sent before the restart
+            await delete_temp(folder_id)
+            lock.close()
+
+
 # Upload a file
 @app.post("/rasters")
 async def upload_raster(file: UploadFile, questionset_id: str = Form(...)):    
 
-    file_list = None
-    zip_file = False
     folder = file.filename
-    return_id = ""
+
     if file.content_type == 'application/zip':
-        id = generate_id()
-        return_id = id
-        log.info(f"Zip file received with id {id}")
-        os.makedirs(os.path.join(cache_dir, id))
-        src_folder = os.path.join(cache_dir, id, folder)
-        with open(src_folder, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-        
+        # the archive is kept until its members are uploaded, which happens after responding
+        folder_id = generate_id()
+        log.info(f"Zip file received with id {folder_id}")
+        archive_file = os.path.join(cache_dir, folder_id, folder)
+        os.makedirs(os.path.dirname(archive_file))
+        # taken before anything is written, so the upload is never resumed by another process
+        lock = lock_ingest(folder_id)
+
+        def save_archive():
+            with open(archive_file, "wb") as f:
+                shutil.copyfileobj(file.file, f)
+
         try:
-            with zipfile.ZipFile(src_folder, 'r') as zip_ref:
-                log.info("Extracting zip file {id}")
-                extract_dir = os.path.join(cache_dir, id)
-                zip_ref.extractall(extract_dir)
-                log.info(f"Extraction complete for {id}")
-                file_list = [os.path.join(extract_dir,file_name) for file_name in zip_ref.namelist()[1:]]
-                zip_file = True
+            await asyncio.to_thread(save_archive)
+            member_names = await asyncio.to_thread(list_zip_members, archive_file)
         except Exception as e:
-            log.error(f'Error in unzipping Zip: {e}')
-            file_list = []
-            zip_file = False
+            log.error(f'Error in reading Zip: {e}')
+            await delete_temp(folder_id)
+            lock.close()
             return RedirectResponse(
                 status_code=400,
-                url=f"/folder/{return_id}",
+                url=f"/folder/{folder_id}",
             )
-        
-        os.remove(src_folder)
-    else:
-        file_list = [file]
-    
-    try:
-        for ref_file in file_list:
+
+        members = []
+        for member in member_names:
             id = generate_id()
-            os.makedirs(os.path.join(cache_dir, id))
-            src_file = os.path.join(cache_dir, id, src)
-            if zip_file:
-                name = os.path.basename(ref_file)
-                shutil.copy(ref_file, src_file)
-            else:
-                return_id = id
-                name = ref_file.filename
-                with open(src_file, "wb") as f:
-                    shutil.copyfileobj(ref_file.file, f)
-            
-            remote_fs.makedirs(id)
-            remote_src_file = os.path.join(id, src)
-            log.info(f"Uploading file to {remote_src_file}")
+            members.append((member, Raster(id=id, name=os.path.basename(member), file=os.path.join(id, src),
+                                           questionset_id=questionset_id)))
 
-            with remote_fs.open(remote_src_file, "wb") as remote_file, \
-                    open(src_file, "rb") as cache_file:
-                shutil.copyfileobj(cache_file, remote_file)
-            
-            log.debug(f"Saving raster entry {id} to database")
+        # kept next to the archive, so the upload can be picked up again after a restart
+        await asyncio.to_thread(save_members, archive_file, folder_id, members)
 
-            with open_db_cursor() as cursor:
-                cursor.execute(
-                    "INSERT INTO raster (id, file, name, folder, folder_id, questionset_id) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
-                    (id, remote_src_file, name, folder, return_id, questionset_id))
-            
-            log.debug(f"Notifying workers of new raster {id}")
+        # the manifest, so that the folder and its progress show up straight away
+        async with open_db_cursor() as cursor:
+            await cursor.executemany(
+                "INSERT INTO raster (id, file, name, folder, folder_id, questionset_id, ingest) VALUES (%s, %s, %s, %s, %s, %s, 'upload') ON CONFLICT DO NOTHING",
+                [(raster.id, raster.file, raster.name, folder, folder_id, questionset_id) for _, raster in members])
+
+        start_ingest(archive_file, folder_id, members, lock)
+
+        return RedirectResponse(
+            status_code=303,
+            url=f"/folder/{folder_id}",
+        )
 
-            raster = Raster(id=id, name=name, file=remote_src_file, questionset_id=questionset_id)
-            await publish_new_raster(raster, subject="raster.new", id=f"raster.new.{id}")
-            # await delete_temp(id)
+    id = generate_id()
+    try:
+        remote_fs.makedirs(id)
+        remote_src_file = os.path.join(id, src)
+        log.info(f"Uploading file to {remote_src_file}")
+
+        # streamed straight to remote storage, hashed on the way
+        with file.file as upload:
+            hash, size = await asyncio.to_thread(upload_and_hash, upload, remote_src_file)
+
+        log.debug(f"Saving raster entry {id} to database")
+
+        async with open_db_cursor() as cursor:
+            await cursor.execute(
+                "INSERT INTO raster (id, file, name, folder, folder_id, questionset_id, hash, size) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                (id, remote_src_file, file.filename, folder, id, questionset_id, hash, size))
+
+        log.debug(f"Notifying workers of new raster {id}")
+
+        raster = Raster(id=id, name=file.filename, file=remote_src_file, questionset_id=questionset_id,
+                        hash=hash, size=size)
+        await publish_new_raster(raster, subject="raster.new", id=f"raster.new.{id}")
 
     except Exception as e:
         log.error(f"Error in uploading file: {e}")
         log.warning("Some files may not have been uploaded")
-    
-    if zip_file:
-        await delete_temp(return_id)
 
     return RedirectResponse(
         status_code=303,
-        url=f"/folder/{return_id}",
+        url=f"/folder/{id}",
     )
 
 # Load templates from DB
@@ -225,14 +438,14 @@ async def upload_raster(file: UploadFile, questionset_id: str = Form(...)):
 async def read_template(request: Request):
     log.info("Received request for questionset")
     try:
-        with open_db_cursor() as cursor:
-            cursor.execute(
+        async with open_db_cursor() as cursor:
+            await cursor.execute(
                 """
                 SELECT id, name, data
                 FROM questionsets
                 """
             )
-            rows = cursor.fetchall()
+            rows = await cursor.fetchall()
         log.debug(f'Questionsets retrieved: {[row["name"] for row in rows]}')
         return JSONResponse(content=rows, headers=json_headers)
     except Exception as e:
@@ -358,8 +571,8 @@ async def save_template(request: Request):
         print('questionset_id type:', type(questionset_id))
         log.debug(f"Updating template {questionset_id} to database")
 
-        with open_db_cursor() as cursor:            
-            cursor.execute(
+        async with open_db_cursor() as cursor:            
+            await cursor.execute(
                 "UPDATE questionsets SET name=%s, effectset=%s, data=%s WHERE id=%s",
                 (file_name, effectset, json_object, questionset_id))        
 
@@ -368,16 +581,16 @@ async def save_template(request: Request):
 
         log.debug(f"Saving template {id} to database")        
 
-        with open_db_cursor() as cursor:            
-            cursor.execute("SELECT * FROM questionsets WHERE name = %s", (file_name,))
-            exist = cursor.fetchall()
+        async with open_db_cursor() as cursor:            
+            await cursor.execute("SELECT * FROM questionsets WHERE name = %s", (file_name,))
+            exist = await cursor.fetchall()
 
             if exist:
                 file_name = file_name + f"({len(exist)})"
                 data["questionset_name"] = file_name
                 json_object = json.dumps(data) 
 
-            cursor.execute(
+            await cursor.execute(
                 "INSERT INTO questionsets (id, name, effectset, data) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING",
                 (id, file_name, effectset, json_object))           
 
@@ -390,8 +603,8 @@ async def save_template(request: Request):
 async def delete_templates(id: str):
     log.info(f"Delete template {id} from database")        
     try:
-        with open_db_cursor() as cursor:            
-            cursor.execute("DELETE FROM questionsets WHERE id=%s", (id,))
+        async with open_db_cursor() as cursor:            
+            await cursor.execute("DELETE FROM questionsets WHERE id=%s", (id,))
         return Response(status_code=200)
     except Exception as e:
         log.error(f"Error deleting questionset template {id}: {e}")
@@ -403,16 +616,16 @@ async def delete_raster(id:str):
     log.info(f"Delete file {id} from remote storage") 
     # delete from remote 
     try:
-        with open_db_cursor() as cursor:            
-            cursor.execute("SELECT id FROM app.raster WHERE folder_id=%s", (id,))
-            rows = cursor.fetchall()
+        async with open_db_cursor() as cursor:            
+            await cursor.execute("SELECT id FROM app.raster WHERE folder_id=%s", (id,))
+            rows = await cursor.fetchall()
         if rows:
             directories = [row['id'] for row in rows]
             for directory in directories:
                 if remote_fs.exists(directory):
                     remote_fs.removetree(directory)
-                    with open_db_cursor() as cursor:            
-                        cursor.execute("DELETE FROM app.raster WHERE id=%s", (directory,))
+                    async with open_db_cursor() as cursor:            
+                        await cursor.execute("DELETE FROM app.raster WHERE id=%s", (directory,))
         return Response(status_code=200)
     except Exception as e:
         log.error(f"Error deleting file {id}: {e}") 
@@ -465,20 +678,11 @@ async def download_result(id: str):
 
 @app.get("/rasters/{id}")
 async def describe_raster(id: str):
-    with open_db_cursor() as cursor:
-        cursor.execute(
+    async with open_db_cursor() as cursor:
+        await cursor.execute(
             """
-            SELECT
-                r.id AS id,
-                r.name AS name,
-                CASE
-                    WHEN EXISTS (SELECT 1 FROM result re WHERE r.id = re.raster) THEN 'Done'
-                    WHEN EXISTS (SELECT 1 FROM chunk c INNER JOIN chunk_result cr ON c.id = cr.chunk WHERE r.id = c.raster) THEN 'Processing'
-                    WHEN EXISTS (SELECT 1 FROM chunk c INNER JOIN chunk_failed cf ON c.id = cf.chunk WHERE r.id = c.raster) THEN 'Processing'
-                    WHEN EXISTS (SELECT 1 FROM raster_valid rv WHERE r.id = rv.raster) THEN 'Queued'
-                    WHEN EXISTS (SELECT 1 FROM raster_invalid ri WHERE r.id = ri.raster) THEN 'Invalid'
-                    ELSE 'New'
-                END AS status
+            SELECT r.id AS id, r.name AS name, r.status AS status,
+                   r.chunks_done AS chunks_done, r.chunks_total AS chunks_total
             FROM raster r
             WHERE r.id = %s
             """,
@@ -487,38 +691,42 @@ async def describe_raster(id: str):
 
         if cursor.rowcount == 0:
             return Response(status_code=404)
-        row = cursor.fetchone()
+        row = await cursor.fetchone()
         return row
 
+
+# status of a folder from the statuses of its rasters
+folder_status = """
+    CASE
+        WHEN bool_and(r.status = 'Invalid') THEN 'Invalid'
+        WHEN bool_and(r.status IN ('Done', 'Invalid')) THEN 'Done'
+        WHEN bool_or(r.status IN ('Processing', 'Done')) THEN 'Processing'
+        WHEN bool_and(r.status = 'Queued') THEN 'Queued'
+        ELSE 'New'
+    END
+"""
+
 @app.get("/folder/{id}")
 async def describe_folder(id: str):
     log.info(f'Getting folder details for {id}')
     try:
-        with open_db_cursor() as cursor:
-            cursor.execute(
-                """
+        async with open_db_cursor() as cursor:
+            await cursor.execute(
+                f"""
                 SELECT
                     r.folder,
                     r.folder_id,
-                    CASE
-                        WHEN COUNT(DISTINCT c.id) - COUNT(DISTINCT res.id) > 0 AND COUNT(DISTINCT r.id) > (COUNT(DISTINCT res.id) + COUNT(DISTINCT i.raster)) THEN 'Processing'
-                        WHEN COUNT(DISTINCT i.raster) = COUNT(DISTINCT r.id) THEN 'Invalid'
-                        WHEN COUNT(DISTINCT res.id) + COUNT(DISTINCT i.raster) = COUNT(DISTINCT r.id) THEN 'Done'
-                        WHEN COUNT(DISTINCT v.raster) = COUNT(DISTINCT r.id) AND COUNT(DISTINCT res.id) = 0 AND COUNT(DISTINCT c.id) = 0 THEN 'Queued'
-                        ELSE 'New'
-                    END AS status,
+                    {folder_status} AS status,
                     CASE
                         WHEN COUNT(v.area) = COUNT(*) THEN SUM(v.area)
                         ELSE NULL
-                    END AS area
+                    END AS area,
+                    SUM(r.chunks_done) AS chunks_done,
+                    SUM(r.chunks_total) AS chunks_total,
+                    COUNT(*) AS rasters,
+                    COUNT(r.hash) AS uploaded
                 FROM
                     app.raster r
-                LEFT JOIN
-                    app.chunk c ON r.id = c.id
-                LEFT JOIN
-                    app.result res ON r.id = res.id
-                LEFT JOIN
-                    app.raster_invalid i ON r.id = i.raster
                 LEFT JOIN
                     app.raster_valid v ON r.id = v.raster
                 WHERE 
@@ -532,7 +740,7 @@ async def describe_folder(id: str):
             if cursor.rowcount == 0:
                 log.info(f"No file matching {id} found")
                 return JSONResponse(status_code = 404, content = {"error": "No file found"})
-            row = cursor.fetchone()
+            row = await cursor.fetchone()
             log.debug(f'Details for {id} :{row}')
             return row
     except Exception as e:
@@ -540,36 +748,61 @@ async def describe_folder(id: str):
         return JSONResponse(status_code = 500, content = {"error": "Error retrieving file"})
 
 
+async def list_raster_page(limit, after=None, status=None, folder_id=None):
+    """
+    Returns up to `limit` valid rasters in id order, starting after the id `after`, or all of
+    them without a limit. The conditions are only added when set, so that each combination gets
+    a plan using its index.
+    """
+    conditions = []
+    params = []
+    if status is not None:
+        conditions.append("r.status = %s")
+        params.append(status)
+    if folder_id is not None:
+        conditions.append("r.folder_id = %s")
+        params.append(folder_id)
+    if after is not None:
+        conditions.append("r.id > %s")
+        params.append(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    if limit is not None:
+        params.append(limit)
+
+    async with open_db_cursor() as cursor:
+        await cursor.execute(
+            f"""
+            SELECT
+                r.id AS id,
+                r.name AS name,
+                rv.latlon AS latlon,
+                rv.height AS height,
+                rv.width as width,
+                rv.effectset AS effectset,
+                rv.area AS area,
+                r.folder AS folder_name,
+                r.folder_id AS folder_id,
+                r.status AS status,
+                r.chunks_done AS chunks_done,
+                r.chunks_total AS chunks_total
+            FROM raster r
+            INNER JOIN raster_valid rv ON r.id = rv.raster
+            {where}
+            ORDER BY r.id
+            {"LIMIT %s" if limit is not None else ""}
+            """,
+            params
+        )
+        return await cursor.fetchall()
+
+
+# pass the id of the last raster of a page as `after` to get the next page
 @app.get("/rasters")
-async def list_rasters():
+async def list_rasters(limit: int = Query(1000, ge=1, le=10000), after: Optional[str] = None,
+                       status: Optional[str] = None, folder_id: Optional[str] = None):
     log.info("Checking status of all jobs")
     try:
-        with open_db_cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT
-                    r.id AS id,
-                    r.name AS name,
-                    rv.latlon AS latlon,
-                    rv.height AS height,
-                    rv.width as width,
-                    rv.effectset AS effectset,
-                    rv.area AS area,
-                    r.folder AS folder_name,
-                    r.folder_id AS folder_id
-                    CASE
-                        WHEN EXISTS (SELECT 1 FROM result re WHERE r.id = re.raster) THEN 'Done'
-                        WHEN EXISTS (SELECT 1 FROM chunk c INNER JOIN chunk_result cr ON c.id = cr.chunk WHERE r.id = c.raster) THEN 'Processing'
-                        WHEN EXISTS (SELECT 1 FROM chunk c INNER JOIN chunk_failed cf ON c.id = cf.chunk WHERE r.id = c.raster) THEN 'Processing'
-                        WHEN EXISTS (SELECT 1 FROM raster_valid rv WHERE r.id = rv.raster) THEN 'Queued'
-                        WHEN EXISTS (SELECT 1 FROM raster_invalid ri WHERE r.id = ri.raster) THEN 'Invalid'
-                        ELSE 'New'
-                    END AS status
-                FROM raster r
-                INNER JOIN raster_valid rv ON r.id = rv.raster
-                """
-            )
-            return cursor.fetchall()
+        return await list_raster_page(limit, after, status, folder_id)
     except Exception as e:
         log.error(f"Error getting rasters: {e}")
         return JSONResponse(status_code = 500, content = {"error": "Error retrieving rasters"})
@@ -578,32 +811,20 @@ async def list_rasters():
 async def list_folders():
     log.info("Checking status of all jobs")
     try:
-        with open_db_cursor() as cursor:
-            cursor.execute(
-                """
+        async with open_db_cursor() as cursor:
+            await cursor.execute(
+                f"""
                     SELECT
                         r.folder AS name,
                         r.folder_id AS id,
                         q.name AS questionset,
-                        CASE
-                            WHEN COUNT(DISTINCT c.id) - COUNT(DISTINCT res.id) > 0 OR COUNT(DISTINCT r.id) > (COUNT(DISTINCT res.id) + COUNT(DISTINCT i.raster)) THEN 'Processing'
-                            WHEN COUNT(DISTINCT i.raster) = COUNT(DISTINCT r.id) THEN 'Invalid'
-                            WHEN COUNT(DISTINCT res.id) + COUNT(DISTINCT i.raster) = COUNT(DISTINCT r.id) THEN 'Done'
-                            WHEN COUNT(DISTINCT v.raster) = COUNT(DISTINCT r.id) AND COUNT(DISTINCT res.id) = 0 THEN 'Queued'
-                            ELSE 'New'
-                        END AS status,
+                        {folder_status} AS status,
                         CASE
                             WHEN COUNT(v.area) = COUNT(*) THEN SUM(v.area)
                             ELSE NULL
                         END AS area
                     FROM
                         app.raster r
-                    LEFT JOIN
-                        app.chunk c ON r.id = c.id
-                    LEFT JOIN
-                        app.result res ON r.id = res.id
-                    LEFT JOIN
-                        app.raster_invalid i ON r.id = i.raster
                     LEFT JOIN
                         app.raster_valid v ON r.id = v.raster
                     INNER JOIN
@@ -612,59 +833,21 @@ async def list_folders():
                         r.folder_id, r.folder, q.name;
                 """
             )
-            return cursor.fetchall()
+            return await cursor.fetchall()
     except Exception as e:
         log.error(f"Error getting folders: {e}")
         return JSONResponse(status_code = 500, content = {"error": "Error retrieving file"})
 
+# a folder is listed in full unless a limit is given, as the map loads all of its rasters at once
 @app.get("/folder/raster/{id}")
-def get_raster_from_folder(id: str):
+async def get_raster_from_folder(id: str, limit: Optional[int] = Query(None, ge=1), after: Optional[str] = None,
+                                 status: Optional[str] = None):
     try:
-        with open_db_cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT
-                    r.id AS id,
-                    r.name AS name,
-                    rv.latlon AS latlon,
-                    rv.height AS height,
-                    rv.width as width,
-                    rv.effectset AS effectset,
-                    rv.area AS area,
-                    r.folder_id AS folder_id,
-                    CASE
-                        WHEN EXISTS (SELECT 1 FROM app.result re WHERE r.id = re.raster) THEN 'Done'
-                        WHEN EXISTS (SELECT 1 FROM app.chunk c INNER JOIN app.chunk_result cr ON c.id = cr.chunk WHERE r.id = c.raster) THEN 'Processing'
-                        WHEN EXISTS (SELECT 1 FROM app.chunk c INNER JOIN app.chunk_failed cf ON c.id = cf.chunk WHERE r.id = c.raster) THEN 'Processing'
-                        WHEN EXISTS (SELECT 1 FROM app.raster_valid rv WHERE r.id = rv.raster) THEN 'Queued'
-                        WHEN EXISTS (SELECT 1 FROM app.raster_invalid ri WHERE r.id = ri.raster) THEN 'Invalid'
-                        ELSE 'New'
-                    END AS status
-                FROM app.raster r
-                INNER JOIN raster_valid rv ON r.id = rv.raster
-                WHERE r.folder_id = %s
-                """,
-                (id, )
-            )
-            return cursor.fetchall()
+        return await list_raster_page(limit, after, status, folder_id=id)
     except Exception as e:
         log.error(f"Error getting raster {id}: {e}")
         return JSONResponse(status_code = 500, content = {"error": "Error retrieving raster"})
 
-def get_vfs_path(remote_fs, path):
-
-    fs_class_name = type(remote_fs).__name__
-    if fs_class_name == 'GCSFS':
-        return f"{remote_fs_url}/{path}" 
-    elif fs_class_name == 'AzureBlobFS':
-        return f"{remote_fs_url}/{path}" 
-    elif fs_class_name == 'BlobFSV2':
-        return f"/vsiaz/{container}/{path}" 
-    elif fs_class_name == 'OSFS':
-        return f"{remote_fs.root_path}/{path}"
-    else:
-        raise ValueError(f"Unsupported filesystem type: {fs_class_name}")
-
 @app.get("/rasters/{id}/tiles/{z}/{y}/{x}.{ext}")
 async def download_source_tile(id: str, z: int, y: int, x: int, ext: str):
     if ext != "png":
@@ -675,7 +858,7 @@ async def download_source_tile(id: str, z: int, y: int, x: int, ext: str):
     log.info(f"Fetching file: {remote_src_file}")
     if remote_fs.exists(remote_src_file):
         try:
-            with Reader(get_vfs_path(remote_fs, remote_src_file)) as src_cog: 
+            with Reader(file_cache.vfs_path(remote_fs, remote_src_file)) as src_cog: 
                 exist = src_cog.tile_exists(x,y,z)
                 if exist:    
                     src_tile = src_cog.tile(x, y, z, indexes=[1,2,3])
@@ -704,7 +887,7 @@ async def download_source_image(id: str, ext: str):
     log.info(f"Looking for {remote_src_file}")
     if remote_fs.exists(remote_src_file):
         try:
-            with Reader(get_vfs_path(remote_fs,remote_src_file)) as tif:
+            with Reader(file_cache.vfs_path(remote_fs, remote_src_file)) as tif:
                 img = tif.read(indexes=[1,2,3])
                 data = img.render(height=256, width=256)
                 return Response(data, media_type=image_media_type)
@@ -722,7 +905,7 @@ async def download_result_image(id: str, band: int, ext: str):
     if remote_fs.exists(remote_dst_file):
         log.info(f"Opening {remote_dst_file}")
         try:
-            with Reader(get_vfs_path(remote_fs,remote_dst_file)) as tif:
+            with Reader(file_cache.vfs_path(remote_fs, remote_dst_file)) as tif:
                 cm = cmap.get('heatmap') 
                 img = tif.read(indexes=band, height=256, width=256) #fixed size to reduce loading time
                 data = img.render(colormap=cm)
@@ -743,7 +926,7 @@ async def download_result_tile(id: str, band: int, z: int, y: int, x: int, ext:
     
     if remote_fs.exists(remote_dst_file):
         try:
-            with Reader(get_vfs_path(remote_fs, remote_dst_file)) as dst_cog: 
+            with Reader(file_cache.vfs_path(remote_fs, remote_dst_file)) as dst_cog: 
                 exist = dst_cog.tile_exists(x,y,z)
 
                 if exist:    
@@ -773,7 +956,7 @@ async def get_metrics(yearly:bool=False,
                       monthly:bool=Query(False, description="if set True, will also overwrite yearly to True")):
     
     
-    with open_db_cursor() as cursor:
+    async with open_db_cursor() as cursor:
         if yearly:
             query = "SELECT * FROM raster_metric_yearly"
         if monthly:
@@ -781,19 +964,19 @@ async def get_metrics(yearly:bool=False,
         if not yearly and not monthly:
             query = "SELECT * FROM raster_metric"
 
-        cursor.execute(query)
-        rows = cursor.fetchall()
+        await cursor.execute(query)
+        rows = await cursor.fetchall()
         data = {"#rows returned": len(rows), "result": rows}
 
     return data   
 
 @app.get("/result/zip/{id}")
-def download_zip_result(id: str):
+async def download_zip_result(id: str):
     # get all raster file names
     log.info(f"Fetching result folder {id}")
     try:
-        with open_db_cursor() as cursor:
-            cursor.execute(
+        async with open_db_cursor() as cursor:
+            await cursor.execute(
                 """
                 SELECT id, name
                 FROM raster
@@ -801,7 +984,7 @@ def download_zip_result(id: str):
                 """,
                 (id, )
             )
-            rows = cursor.fetchall()
+            rows = await cursor.fetchall()
         if rows:
             rasters = {row['id']: row['name'] for row in rows}
             log.debug(f"Files from folder {id}: {rasters}")
@@ -831,12 +1014,12 @@ def download_zip_result(id: str):
         return JSONResponse(status_code = 500, content = {"error": "Error downloading result zip file"})
 
 @app.get("/source/zip/{id}")
-def download_src_zip(id: str):
+async def download_src_zip(id: str):
     # get all raster file names
     log.info(f"Fetching source folder {id}")
     try:
-        with open_db_cursor() as cursor:
-            cursor.execute(
+        async with open_db_cursor() as cursor:
+            await cursor.execute(
                 """
                 SELECT id, name
                 FROM raster
@@ -844,7 +1027,7 @@ def download_src_zip(id: str):
                 """,
                 (id, )
             )
-            rows = cursor.fetchall()
+            rows = await cursor.fetchall()
         if rows:
             rasters = {row['id']: row['name'] for row in rows}
             log.debug(f"Files from folder {id}: {rasters}")
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import ColorInterp
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+for module in ("nats_worker", "psycopg_pool", "rio_cogeo", "pyproj"):
+    pytest.importorskip(module)
+
+from anomaly.background import Grid, slice_chunk  # noqa: E402
+
+profile = dict(driver="GTiff", width=500, height=600, dtype="uint8", crs="EPSG:3857",
+               transform=from_origin(0, 0, 1, 1), tiled=True, blockxsize=256, blockysize=256)
+grid = Grid(raster_width=500, raster_height=600, tiles_x_per_chunk=2, tiles_y_per_chunk=2)
+
+
+def check_slice(src_file, dst_file):
+    with rasterio.open(src_file) as src:
+        col_off, row_off = slice_chunk(src, grid, 1, 1, dst_file)
+        with rasterio.open(dst_file) as dst:
+            window = Window(col_off, row_off, dst.width, dst.height)
+            assert np.array_equal(dst.read(), src.read(window=window))
+            assert np.array_equal(dst.dataset_mask(), src.dataset_mask(window=window))
+            assert dst.colorinterp == src.colorinterp
+            return dst.colormap(1) if dst.colorinterp[0] == ColorInterp.palette else None
+
+
+def test_slice_jpeg_ycbcr_with_mask(tmp_path):
+    data = np.random.default_rng(0).integers(0, 256, (3, 600, 500), dtype=np.uint8)
+    mask = np.full((600, 500), 255, dtype=np.uint8)
+    mask[:300] = 0
+
+    src_file = str(tmp_path / "src.tif")
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True), \
+            rasterio.open(src_file, "w", count=3, compress="jpeg", photometric="ycbcr", **profile) as src:
+        src.write(data)
+        src.write_mask(mask)
+
+    check_slice(src_file, str(tmp_path / "slice.tif"))
+
+
+def test_slice_palette(tmp_path):
+    data = np.random.default_rng(0).integers(0, 256, (1, 600, 500), dtype=np.uint8)
+    colormap = {i: (i, 255 - i, 0, 255) for i in range(256)}
+
+    src_file = str(tmp_path / "src.tif")
+    with rasterio.open(src_file, "w", count=1, photometric="palette", **profile) as src:
+        src.write(data)
+        src.write_colormap(1, colormap)
+
+    assert check_slice(src_file, str(tmp_path / "slice.tif")) == colormap